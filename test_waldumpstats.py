@@ -0,0 +1,91 @@
+import random
+import tracemalloc
+import unittest
+
+import waldumpstats
+from waldumpstats import Tracker
+
+def waldump_line(rmgr, xid, lsn, desc):
+    return (b"rmgr: %-11s len (rec/tot): %6d/%6d, tx: %10d, lsn: 0/%08X, prev 0/%08X, desc: %s" % (
+        rmgr.encode(), 72, 72, xid, lsn, lsn - 0x48, desc.encode()))
+
+def open_transactions(count, first_xid=1000):
+    """Lines of count transactions modifying a tuple each, none ending."""
+    return [waldump_line("Heap", first_xid + i, 0x1000000 + 0x48*i,
+                         "INSERT off 1 flags 0x00, blkref #0: rel 1663/1/2 blk 3")
+            for i in range(count)]
+
+def random_dump(nlines, seed=1):
+    """Lines of interleaved transactions that mostly commit or abort."""
+    rng = random.Random(seed)
+    lines = []
+    xid = 1000
+    lsn = 0x1000000
+    open_xids = []
+    for i in range(nlines):
+        lsn += 0x48
+        if len(open_xids) < 20 or rng.random() < 0.05:
+            xid += 1
+            open_xids.append(xid)
+        x = rng.choice(open_xids)
+        r = rng.random()
+        if r < 0.8:
+            lines.append(waldump_line("Heap", x, lsn, "UPDATE off 1 xmax %d ; new off 2 xmax 0" % x))
+        else:
+            open_xids.remove(x)
+            end = "COMMIT" if r < 0.97 else "ABORT"
+            lines.append(waldump_line("Transaction", x, lsn,
+                                      "%s 2024-05-15 11:14:34.%06d EEST" % (end, i % 1000000)))
+    return lines
+
+def commit_updates(tracker):
+    return {xid: packed[2] if packed else 0
+            for xid, subxids, packed, lsn, commit_time in tracker.commits
+            if commit_time is not None}
+
+class MaxRunningTest(unittest.TestCase):
+    def test_entries_bounded(self):
+        tracker = Tracker(max_running=100)
+        for line in open_transactions(20000):
+            tracker.feed([line])
+            self.assertLessEqual(len(tracker.running), 100)
+            self.assertLessEqual(len(tracker.spilled.counts), 100)
+            self.assertLessEqual(len(tracker.spilled_lsn), 100)
+        self.assertEqual(tracker.evicted, 20000 - len(tracker.running))
+
+    def test_peak_memory(self):
+        lines = open_transactions(20000)
+        peaks = []
+        for max_running in (None, 100):
+            tracker = Tracker(max_running=max_running)
+            tracemalloc.start()
+            for i in range(0, len(lines), 1000):
+                tracker.feed(lines[i:i + 1000])
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        uncapped, capped = peaks
+        self.assertLess(capped, uncapped/10)
+
+    def test_updates_within_bound(self):
+        lines = random_dump(50000)
+        exact = Tracker(keep_commits=True)
+        exact.feed(lines)
+        capped = Tracker(keep_commits=True, max_running=8)
+        capped.feed(lines)
+        self.assertGreater(capped.evicted, 0)
+        floor = capped.spilled.floor
+        expected = commit_updates(exact)
+        got = commit_updates(capped)
+        self.assertEqual(got.keys(), expected.keys())
+        for xid, updates in expected.items():
+            self.assertLessEqual(got[xid], updates)
+            self.assertLessEqual(updates, got[xid] + floor)
+
+    def test_uncapped_summary_unused(self):
+        tracker = Tracker()
+        tracker.feed(random_dump(5000))
+        self.assertEqual(tracker.evicted, 0)
+        self.assertEqual(tracker.spilled.counts, {})
+
+if __name__ == "__main__":
+    unittest.main()
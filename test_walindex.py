@@ -0,0 +1,67 @@
+import shutil
+import tempfile
+import unittest
+
+import walgen
+import walindex
+import xlogfilter
+from xlogfilter import XLOG_BLCKSZ, XLOG_SIZE, LONG_HEADER_LEN, HEADER_LEN
+
+def record_end(lsn, tot_len):
+    """Where a record of tot_len bytes from lsn ends, past the page headers
+    it crosses."""
+    end = lsn
+    while tot_len:
+        if end % XLOG_SIZE == 0:
+            end += LONG_HEADER_LEN
+        elif end % XLOG_BLCKSZ == 0:
+            end += HEADER_LEN
+        amount = min(tot_len, XLOG_BLCKSZ - end % XLOG_BLCKSZ)
+        end += amount
+        tot_len -= amount
+    return end
+
+class FindLsnTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.waldir = tempfile.mkdtemp(prefix="walindex")
+        cls.indexdir = tempfile.mkdtemp(prefix="walindex")
+        walgen.generate(cls.waldir, 2)
+        walindex.build(cls.waldir, 1, 1, cls.indexdir)
+        cls.index = walindex.WalIndex(cls.indexdir)
+        cls.records = [(rec.lsn, rec.header.tot_len)
+                       for rec in xlogfilter.records(cls.waldir, 1, 1, verbose=False)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.waldir)
+        shutil.rmtree(cls.indexdir)
+
+    def test_records_spanning_pages(self):
+        spanning = [(lsn, tot_len) for lsn, tot_len in self.records
+                    if lsn // XLOG_BLCKSZ != (lsn + tot_len - 1) // XLOG_BLCKSZ]
+        self.assertTrue(spanning)
+        for lsn, tot_len in spanning:
+            end = record_end(lsn, tot_len)
+            for probe in (lsn, lsn + tot_len - 1, end - 1):
+                entry = self.index.find_lsn(probe)
+                self.assertIsNotNone(entry, xlogfilter.format_lsn(probe))
+                self.assertEqual(entry.lsn, lsn)
+
+    def test_record_spanning_segments(self):
+        crossing = [(lsn, tot_len) for lsn, tot_len in self.records
+                    if record_end(lsn, tot_len) > (lsn // XLOG_SIZE + 1)*XLOG_SIZE]
+        self.assertTrue(crossing)
+        for lsn, tot_len in crossing:
+            self.assertEqual(self.index.find_lsn(record_end(lsn, tot_len) - 1).lsn, lsn)
+
+    def test_padding_and_past_end(self):
+        for (lsn, tot_len), (next_lsn, _) in zip(self.records, self.records[1:]):
+            end = record_end(lsn, tot_len)
+            if end < next_lsn and end // XLOG_BLCKSZ == next_lsn // XLOG_BLCKSZ:
+                self.assertIsNone(self.index.find_lsn(end))
+        lsn, tot_len = self.records[-1]
+        self.assertIsNone(self.index.find_lsn(record_end(lsn, tot_len)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import walgen
+import xlogfilter
+from xlogfilter import RECORD_FORMATS, XLOG_SIZE
+
+SEGMENT = "000000010000000000000001"
+
+class VerifyRecordsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.waldir = tempfile.mkdtemp(prefix="xlogfilter")
+        walgen.generate(cls.waldir, 1)
+        with open(os.path.join(cls.waldir, SEGMENT), 'rb') as fd:
+            cls.segment = fd.read()
+        cls.records = [(rec.lsn, rec.header.tot_len)
+                       for rec in xlogfilter.records(cls.waldir, 1, 1, verbose=False)]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.waldir)
+
+    def verify(self, data):
+        waldir = tempfile.mkdtemp(prefix="xlogfilter")
+        try:
+            with open(os.path.join(waldir, SEGMENT), 'wb') as fd:
+                fd.write(data)
+            reader = xlogfilter.xlogreader(xlogfilter.xlogfilereader(waldir, 1, 1, verbose=False))
+            reader.skip_contrecord()
+            return xlogfilter.verify_records(reader, RECORD_FORMATS["legacy"])
+        finally:
+            shutil.rmtree(waldir)
+
+    def test_complete_segment(self):
+        nrecs, bad_lsn = self.verify(self.segment)
+        self.assertIsNone(bad_lsn)
+
+    def test_truncated_in_record(self):
+        i = len(self.records)//2
+        lsn, tot_len = self.records[i]
+        nrecs, bad_lsn = self.verify(self.segment[:lsn - XLOG_SIZE + tot_len//2])
+        self.assertEqual(bad_lsn, lsn)
+        self.assertEqual(nrecs, i)
+
+    def test_truncated_at_record(self):
+        i = len(self.records)//2
+        lsn, tot_len = self.records[i]
+        nrecs, bad_lsn = self.verify(self.segment[:lsn - XLOG_SIZE])
+        self.assertEqual(bad_lsn, lsn)
+        self.assertEqual(nrecs, i)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""Throughput benchmarks of the WAL tools.
+
+Times reading records with and without their backup blocks, checking
+CRCs, filtering and rewriting records as XLOG_NOOP, and reports MB/s of
+WAL and records/s for each. Runs on the given segments, or on WAL from
+walgen.py written to a temporary directory so the numbers are
+reproducible anywhere."""
+from collections import namedtuple
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import walgen
+import xlogfilter
+from xlogfilter import RECORD_FORMATS, XLOG_SIZE
+
+BenchResult = namedtuple("BenchResult", ['name', 'seconds', 'records', 'nbytes'])
+
+class NullWriter(object):
+    """Counts what filter_machine writes, so the disk stays out of it."""
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, data):
+        self.nbytes += len(data)
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.nbytes += len(data)
+
+    def close(self):
+        pass
+
+def bench_read(path, tli, seg, blocks=False):
+    nrecs = 0
+    end_lsn = seg*XLOG_SIZE
+    start = time.perf_counter()
+    for rec in xlogfilter.records(path, tli, seg, verbose=False):
+        nrecs += 1
+        end_lsn = rec.lsn + rec.header.tot_len
+        if blocks:
+            rec.blocks
+    return time.perf_counter() - start, nrecs, end_lsn - seg*XLOG_SIZE
+
+def bench_crc(path, tli, seg):
+    reader = xlogfilter.xlogreader(xlogfilter.xlogfilereader(path, tli, seg, verbose=False))
+    reader.skip_contrecord()
+    start = time.perf_counter()
+    nrecs, bad_lsn = xlogfilter.verify_records(reader, RECORD_FORMATS["legacy"])
+    elapsed = time.perf_counter() - start
+    if bad_lsn is not None:
+        raise ValueError("bad record at %s" % xlogfilter.format_lsn(bad_lsn))
+    return elapsed, nrecs, reader.pos - seg*XLOG_SIZE
+
+def bench_filter(path, tli, seg, rec_filter):
+    """Times filter_machine without FilterStats, whose timed reads and writes
+    would be part of the number. The records are counted beforehand."""
+    nrecs = sum(1 for rec in xlogfilter.records(path, tli, seg, verbose=False))
+    start_file = xlogfilter.segment_file(path, tli, seg)
+    dest = NullWriter()
+    start = time.perf_counter()
+    # The filter reports every record it filters, as it does in real runs
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        xlogfilter.filter_machine(seg*XLOG_SIZE, xlogfilter.read_files(start_file, verbose=False),
+                                  dest, rec_filter)
+    return time.perf_counter() - start, nrecs, dest.nbytes
+
+def bench_noop(path, tli, seg, count=20000):
+    """Rewrites the first count records as XLOG_NOOP in a buffer."""
+    headers = []
+    for rec in xlogfilter.records(path, tli, seg, verbose=False):
+        if rec.header.rmid != xlogfilter.RM_XLOG_ID:
+            headers.append(rec.header)
+        if len(headers) == count:
+            break
+    buf = bytearray(64)
+    start = time.perf_counter()
+    for header in headers:
+        xlogfilter.write_noop_rec(buf, header)
+    return (time.perf_counter() - start, len(headers),
+            sum(header.tot_len for header in headers))
+
+def run(path, tli, seg, rec_filter, benches, repeat=3):
+    """Runs each of benches repeat times, keeping the fastest run."""
+    results = []
+    for name in benches:
+        best = None
+        for i in range(repeat):
+            if name == "read":
+                timing = bench_read(path, tli, seg)
+            elif name == "blocks":
+                timing = bench_read(path, tli, seg, blocks=True)
+            elif name == "crc":
+                timing = bench_crc(path, tli, seg)
+            elif name == "filter":
+                timing = bench_filter(path, tli, seg, rec_filter)
+            else:
+                timing = bench_noop(path, tli, seg)
+            if best is None or timing[0] < best[0]:
+                best = timing
+        results.append(BenchResult(name, *best))
+    return results
+
+BENCHES = ["read", "blocks", "crc", "filter", "noop"]
+
+from optparse import OptionParser
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] [startseg]")
+    parser.add_option("-n", "--segments", dest="segments", type="int", default=4,
+                      help="Without startseg, generate this many segments [default: %default]")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="Seed of the generated WAL [default: %default]")
+    parser.add_option("-x", "--exclude", dest="exclude", action="append", type="string",
+                      help="Filenode to filter in the filter benchmark "
+                           "[default: the first generated one]. Format: tablespaceoid,databaseoid,filenode")
+    parser.add_option("-b", "--bench", dest="benches", action="append", type="choice",
+                      choices=BENCHES, help="Run only this benchmark, repeatable: %s" % ", ".join(BENCHES))
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Runs of each benchmark, the fastest counts [default: %default]")
+    parser.add_option("--json", dest="json", action="store_true", default=False,
+                      help="Print the results as JSON")
+    (options, args) = parser.parse_args()
+    if len(args) > 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    excludes = set()
+    for exclude in options.exclude or []:
+        match = xlogfilter.filenode_re.match(exclude)
+        if not match:
+            print("Invalid filenode %s" % exclude)
+            sys.exit(1)
+        excludes.add(xlogfilter.RelFileNode(*map(int, match.groups())))
+
+    tmpdir = None
+    try:
+        if args:
+            path = os.path.dirname(args[0]) or "."
+            tli, seg = xlogfilter.parse_xlog_filename(os.path.basename(args[0]))
+        else:
+            tmpdir = path = tempfile.mkdtemp(prefix="walbench")
+            tli, seg = 1, 1
+            walgen.generate(path, options.segments, options.seed, switch_every=4)
+            excludes = excludes or set(walgen.DEFAULT_NODES[:1])
+        rec_filter = xlogfilter.RecordFilter(excludes)
+        results = run(path, tli, seg, rec_filter, options.benches or BENCHES, options.repeat)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    if options.json:
+        json.dump([dict(result._asdict(), seconds=round(result.seconds, 4),
+                        records_per_sec=round(result.records/max(result.seconds, 1e-9)),
+                        mb_per_sec=round(result.nbytes/1e6/max(result.seconds, 1e-9), 2))
+                   for result in results], sys.stdout, indent=1)
+        print()
+        return
+    for result in results:
+        seconds = max(result.seconds, 1e-9)
+        print("%-8s %8.3fs %9d records %8.1f MB %10.0f records/s %8.1f MB/s" % (
+            result.name, result.seconds, result.records, result.nbytes/1e6,
+            result.records/seconds, result.nbytes/1e6/seconds))
+
+if __name__ == "__main__":
+    main()
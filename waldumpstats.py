@@ -1,16 +1,30 @@
-import collections
+from collections import Counter, namedtuple
 import heapq
 import json
+import multiprocessing
+import os
 import sys
 import re
+from operator import itemgetter
+from optparse import OptionParser
 
 N = 10
+# Lines are read in blocks of this many bytes
+BLOCK_SIZE = 4*1024*1024
+# Lines between progress reports
+REPORT_EVERY = 1000000
+# Bytes of pg_waldump output per shard with --jobs
+SHARD_SIZE = 64*1024*1024
+# Keys kept by each SpaceSaving sketch with --relations
+SKETCH_SIZE = 10000
 
 #def format_lsn(lsn):
 #    h = f"{lsn:09X}"
 #    return h[:-8]+"/"+h[-8:]
 
 class Stats:
+    __slots__ = ('xid', 'first_lsn', 'commit_time', 'commit_lsn', 'num_updates')
+
     def __init__(self, xid, first_lsn):
         self.xid = xid
         self.first_lsn = first_lsn
@@ -41,11 +55,27 @@ def print_stats(lsn, topN):
 
 def print_running(running, n=3):
     print(f"  Top {n} running:")
-    for s in sorted(running.values(), key=lambda s: s.num_updates, reverse=True)[:3]:
-        print(f"{s}")
+    for xid, entry in sorted(running.items(), key=lambda item: item[1].num_updates, reverse=True)[:3]:
+        print(f"{entry.stats(xid)}")
+
+class Running:
+    """A running transaction, keyed by its xid in Tracker.running. Only a
+    Stats once it commits."""
+    __slots__ = ('first_lsn', 'num_updates')
+
+    def __init__(self, first_lsn, num_updates=0):
+        self.first_lsn = first_lsn
+        self.num_updates = num_updates
+
+    def merge(self, other):
+        self.first_lsn = min(self.first_lsn, other.first_lsn)
+        self.num_updates += other.num_updates
+
+    def stats(self, xid):
+        stat = Stats(xid.lstrip().decode(), self.first_lsn.decode())
+        stat.num_updates = self.num_updates
+        return stat
 
-running = collections.defaultdict(int)
-topN = [(0,None)]*N
 
 """
 rmgr: Heap        len (rec/tot):     72/    72, tx:     461970, lsn: 0/233C8568, prev 0/233C8520, desc: HOT_UPDATE off 159 xmax 461970 flags 0x20 ; new off 161 xmax 0, blkref #0: rel 1663/13993/16397 blk 5
@@ -53,7 +83,7 @@ rmgr: Heap        len (rec/tot):     79/    79, tx:     461971, lsn: 0/233C85B0,
 rmgr: Heap        len (rec/tot):     79/    79, tx:     461970, lsn: 0/233C8600, prev 0/233C85B0, desc: INSERT off 98 flags 0x00, blkref #0: rel 1663/13993/16406 blk 2938
 rmgr: Transaction len (rec/tot):     34/    34, tx:     461971, lsn: 0/233C8650, prev 0/233C8600, desc: COMMIT 2024-05-15 11:14:34.639229 EEST
 """
-parse_re = re.compile(r"rmgr: ([A-Za-z0-9]+) *len \(rec/tot\):\s*\d+/\s*\d+, tx:\s*(\d+), lsn: ([0-9A-F]+/[0-9A-F]+), prev [0-9A-F]+/[0-9A-F]+, desc: ([A-Z_+]+)? (.*)")
+parse_re = re.compile(rb"rmgr: ([A-Za-z0-9]+) *len \(rec/tot\):\s*\d+/\s*\d+, tx:\s*(\d+), lsn: ([0-9A-F]+/[0-9A-F]+), prev [0-9A-F]+/[0-9A-F]+, desc: ([A-Z_+]+)? (.*)")
 """
 ('Heap',
  '461970',
@@ -63,45 +93,642 @@ parse_re = re.compile(r"rmgr: ([A-Za-z0-9]+) *len \(rec/tot\):\s*\d+/\s*\d+, tx:
 """
 
 
-MOD_CMDS = ('UPDATE', 'HOT_UPDATE', 'INSERT', 'DELETE', 'INSERT+INIT')
+MOD_CMDS = frozenset([b'UPDATE', b'HOT_UPDATE', b'INSERT', b'DELETE', b'INSERT+INIT'])
+# What desc starts with for them, for startswith
+MOD_PREFIXES = tuple(cmd + b' ' for cmd in MOD_CMDS)
+END_PREFIXES = (b'COMMIT ', b'ABORT ')
 
-last_lsn = None
+# pg_waldump prints "rmgr: %-11s len (rec/tot): %6u/%6u, tx: %10u, lsn: %X/%08X, ..."
+# so as long as the names and lengths fit their widths, tx and the start of
+# lsn are at fixed positions. Xids are kept padded to that width.
+TX_SEP = b", tx: "
+DESC_SEP = b", desc: "
+XID_WIDTH = 10
+OLDEST_RUNNING = b"oldestRunningXid "
 
-for i, line in enumerate(sys.stdin):
+def xid_precedes(a, b):
+    """TransactionIdPrecedes, for normal xids."""
+    return (a - b) & 0xFFFFFFFF >= 0x80000000
+
+def oldest_running(rest):
+    """oldestRunningXid of a RUNNING_XACTS desc, or None."""
+    i = rest.find(OLDEST_RUNNING)
+    if i < 0:
+        return None
+    xid = rest[i + len(OLDEST_RUNNING):].split(None, 1)[0].rstrip(b";")
+    return int(xid) if xid.isdigit() else None
+
+def parse_slow(line):
+    """(rmgr, xid, lsn, cmd, rest) of a line matching parse_re, else None."""
     match = parse_re.match(line)
     if not match:
-        print(line)
-        sys.exit(1)
-        continue
+        return None
     rmgr, xid, lsn, cmd, rest = match.groups()
-    if rmgr == 'Heap' and cmd in MOD_CMDS:
-        stat = running.get(xid)
-        if stat is None:
-            stat = Stats(xid, lsn)
-            running[xid] = stat
-        stat.num_updates += 1
-    if rmgr == 'Transaction' and cmd == 'COMMIT':
-        restparts = rest.split('; ')
-        xids = []
-        for part in restparts:
-            if part.startswith('subxacts: '):
-                xids.extend(part[len('subxacts: '):].split(' '))
-        stat = running.pop(xid, None)
-        for xid in xids:
-            if xid not in running:
+    return rmgr, xid.rjust(XID_WIDTH), lsn, cmd or b"", rest
+
+def parse_line(line):
+    """Like parse_slow, but slices lines laid out as pg_waldump does at fixed
+    positions, only using parse_re for lines that aren't."""
+    d = line.find(DESC_SEP, 69) + 8
+    e = line.find(b" ", d)
+    if line[46:52] != TX_SEP or d < 8 or e < 0 or line[:6] != b"rmgr: ":
+        return parse_slow(line)
+    return line[6:17].rstrip(), line[52:62], line[69:line.find(b",", 69)], line[d:e], line[e+1:]
+
+class SpaceSaving:
+    """Heavy hitters of a weighted stream in bounded memory, with the
+    space-saving algorithm taking batches: at most k keys are counted, and
+    new keys start from floor, which is also their error. floor bounds the
+    true count of any key not kept: trim raises it to the smallest count
+    it keeps, which is at least any count it drops. Any key with more than
+    1/k of the total weight is kept, and its true count is between
+    count - error and count."""
+    def __init__(self, k=SKETCH_SIZE):
+        self.k = k
+        self.counts = {}
+        self.floor = 0
+
+    def update(self, counts):
+        """Adds a batch of exact counts, a dict of key to weight."""
+        own = self.counts
+        floor = self.floor
+        for key, weight in counts.items():
+            entry = own.get(key)
+            if entry is None:
+                own[key] = [weight + floor, floor]
+            else:
+                entry[0] += weight
+        self.trim()
+
+    def merge(self, other):
+        """Adds the counts of another sketch. Keys missing from one of them
+        can have had up to its floor there, and keys missing from both up to
+        the sum of the floors."""
+        merged = {}
+        for key, (count, error) in self.counts.items():
+            merged[key] = [count + other.floor, error + other.floor]
+        for key, (count, error) in other.counts.items():
+            entry = merged.get(key)
+            if entry is None:
+                merged[key] = [count + self.floor, error + self.floor]
+            else:
+                entry[0] += count - other.floor
+                entry[1] += error - other.floor
+        self.counts = merged
+        self.floor += other.floor
+        self.trim()
+
+    def trim(self):
+        """Drops all but the k largest counts, raising floor to them."""
+        own = self.counts
+        if len(own) <= self.k:
+            return
+        floor = sorted([entry[0] for entry in own.values()])[-self.k]
+        kept = {key: entry for key, entry in own.items() if entry[0] > floor}
+        for key, entry in own.items():
+            if len(kept) == self.k:
+                break
+            if entry[0] == floor:
+                kept[key] = entry
+        self.counts = kept
+        self.floor = max(self.floor, floor)
+
+    def top(self, n):
+        """[(key, count, error)] of the n largest counts."""
+        return [(key, count, error) for key, (count, error)
+                in heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])]
+
+# blkref #0: rel 1663/13993/16397 fork fsm blk 5 FPW
+blkref_re = re.compile(rb"blkref #\d+: rel ((\d+/\d+/\d+(?: fork \w+)?) blk \d+)( FPW)?")
+# From the first of several block references of a line to the second
+multi_blkref_re = re.compile(rb"blkref #[^\n]*, blkref #")
+len_re = re.compile(rb"len \(rec/tot\):\s*(\d+)/\s*(\d+)")
+
+class BlockStats:
+    """Relations and blocks by the records referencing them, each record
+    counted once per relation and block, and by the bytes of full page
+    images of them, in SpaceSaving sketches. The full
+    page image bytes of a record are its tot - rec length, split between
+    its FPW block references. Keys are the "spc/db/rel[ fork f]" and
+    "spc/db/rel[ fork f] blk b" of the block references."""
+    def __init__(self, k=SKETCH_SIZE):
+        self.rel_updates = SpaceSaving(k)
+        self.rel_fpi = SpaceSaving(k)
+        self.block_updates = SpaceSaving(k)
+        self.block_fpi = SpaceSaving(k)
+
+    def feed(self, lines):
+        """Counts the block references of the lines, a batch at a time."""
+        text = b"\n".join(lines)
+        refs = blkref_re.findall(text)
+        block_updates = Counter(map(itemgetter(0), refs))
+        rel_updates = Counter(map(itemgetter(1), refs))
+        for match in multi_blkref_re.finditer(text):
+            # Take back the repeats within the record
+            end = text.find(b"\n", match.end())
+            refs = blkref_re.findall(text, match.start(), end if end >= 0 else len(text))
+            for counts, keys in ((block_updates, [ref[0] for ref in refs]),
+                                 (rel_updates, [ref[1] for ref in refs])):
+                for key in keys:
+                    counts[key] -= 1
+                for key in set(keys):
+                    counts[key] += 1
+        self.block_updates.update(block_updates)
+        self.rel_updates.update(rel_updates)
+        rel_fpi = {}
+        block_fpi = {}
+        end = 0
+        while True:
+            # Only few lines have full page images, so go from one to the next
+            i = text.find(b" FPW", end)
+            if i < 0:
+                break
+            end = text.find(b"\n", i)
+            if end < 0:
+                end = len(text)
+            line = text[text.rfind(b"\n", 0, i) + 1:end]
+            refs = blkref_re.findall(line)
+            if line[39:40] == b"/" and line[46:52] == TX_SEP:
+                rec_len, tot_len = int(line[33:39]), int(line[40:46])
+            else:
+                rec_len, tot_len = map(int, len_re.search(line).groups())
+            fpws = [(block, rel) for block, rel, fpw in refs if fpw]
+            fpi_len = (tot_len - rec_len)//max(len(fpws), 1)
+            if fpi_len <= 0:
+                continue
+            for block, rel in fpws:
+                rel_fpi[rel] = rel_fpi.get(rel, 0) + fpi_len
+                block_fpi[block] = block_fpi.get(block, 0) + fpi_len
+        self.rel_fpi.update(rel_fpi)
+        self.block_fpi.update(block_fpi)
+
+    def merge(self, other):
+        self.rel_updates.merge(other.rel_updates)
+        self.rel_fpi.merge(other.rel_fpi)
+        self.block_updates.merge(other.block_updates)
+        self.block_fpi.merge(other.block_fpi)
+
+def print_blocks(blocks, n=N):
+    for title, sketch, what in [("Relations by records", blocks.rel_updates, "records"),
+                                ("Relations by FPI bytes", blocks.rel_fpi, "fpi_bytes"),
+                                ("Blocks by records", blocks.block_updates, "records"),
+                                ("Blocks by FPI bytes", blocks.block_fpi, "fpi_bytes")]:
+        print(f"=== {title} ===")
+        for key, count, error in sketch.top(n):
+            rel, _, blk = key.decode().partition(" blk ")
+            rel, _, fork = rel.partition(" fork ")
+            ref = {"rel": rel, "fork": fork or "main"}
+            if blk:
+                ref["blk"] = int(blk)
+            ref[what] = count
+            ref["error"] = error
+            print(f"{count:8d}: {json.dumps(ref)}")
+
+def read_lines(fd, block_size=BLOCK_SIZE, length=None):
+    """Yields lists of the lines of the binary file fd, without line ends.
+    With length only that many bytes are read."""
+    tail = b""
+    while True:
+        if length is not None:
+            if length <= 0:
+                break
+            block = fd.read(min(block_size, length))
+            length -= len(block)
+        else:
+            block = fd.read(block_size)
+        if not block:
+            break
+        lines = block.split(b"\n")
+        lines[0] = tail + lines[0]
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
+
+def read_files(paths):
+    """read_lines of each of paths in turn."""
+    for path in paths:
+        with open(path, 'rb') as fd:
+            yield from read_lines(fd)
+
+class BadLine(ValueError):
+    """A line that is not pg_waldump output. Raised rather than exiting so
+    that it also gets out of pool workers."""
+
+def bad_line(line):
+    raise BadLine(line.decode(errors="replace"))
+
+class Tracker:
+    """Heap modifications of running transactions, and the top N committed
+    transactions by modifications.
+
+    Transactions leave running when they commit or abort, or when a
+    RUNNING_XACTS record has a newer oldest running xid, which means their
+    end is not in the dump. With max_running, the ones with the fewest
+    modifications are evicted down to half of it when there are more, into
+    spilled, a SpaceSaving of their updates keeping at most max_running of
+    them, and spilled_lsn, their first lsns. Ending transactions take back
+    count - error of their spilled updates, so updates can be short by up
+    to spilled.floor, but never more.
+
+    With keep_commits all commits and aborts are kept in commits as
+    (xid, subxids, (xid, first lsn, updates) or None, lsn, commit time or
+    None for aborts) instead, for merge_shards to pick from."""
+    def __init__(self, n=N, keep_commits=False, max_running=None, blocks=None):
+        self.running = {}
+        self.blocks = blocks
+        self.topN = [(0,None)]*n
+        self.last_lsn = None
+        self.commits = [] if keep_commits else None
+        self.max_running = max_running
+        self.horizon = None
+        self.pruned = 0
+        self.evicted = 0
+        # Only filled with max_running
+        self.spilled = SpaceSaving(max_running or SKETCH_SIZE)
+        self.spilled_lsn = {}
+
+    def add(self, rmgr, xid, lsn, cmd, rest):
+        if rmgr == b'Heap':
+            if cmd in MOD_CMDS:
+                self.modify(xid, lsn)
+        elif rmgr == b'Transaction':
+            if cmd == b'COMMIT':
+                self.commit(xid, lsn, rest)
+            elif cmd == b'ABORT':
+                self.abort(xid, lsn, rest)
+        elif rmgr == b'Standby' and cmd == b'RUNNING_XACTS':
+            self.running_xacts(rest)
+
+    def modify(self, xid, lsn):
+        entry = self.running.get(xid)
+        if entry is not None:
+            entry.num_updates += 1
+            return
+        self.running[xid] = Running(lsn, 1)
+        if self.max_running and len(self.running) > self.max_running:
+            self.evict()
+
+    def evict(self):
+        """Drops the running transactions with the fewest modifications,
+        oldest first, down to half of max_running."""
+        running = self.running
+        coldest = sorted(running.items(), key=lambda item: item[1].num_updates)
+        coldest = coldest[:len(running) - self.max_running//2]
+        counts = {}
+        for xid, entry in coldest:
+            del running[xid]
+            counts[xid] = entry.num_updates
+            self.spill_lsn(xid, entry.first_lsn)
+        self.spilled.update(counts)
+        self.trim_lsns()
+        self.evicted += len(coldest)
+
+    def spill_lsn(self, xid, first_lsn):
+        lsn = self.spilled_lsn.get(xid)
+        if lsn is None or first_lsn < lsn:
+            self.spilled_lsn[xid] = first_lsn
+
+    def trim_lsns(self):
+        """Drops the first lsns of the transactions spilled dropped."""
+        counts = self.spilled.counts
+        if len(self.spilled_lsn) > len(counts):
+            self.spilled_lsn = {xid: lsn for xid, lsn in self.spilled_lsn.items()
+                                if xid in counts}
+
+    def unspill(self, xid):
+        """Removes the transaction from spilled. Returns a Running with the
+        updates it surely had there, or None."""
+        spilled = self.spilled.counts.pop(xid, None)
+        if spilled is None:
+            return None
+        count, error = spilled
+        return Running(self.spilled_lsn.pop(xid), count - error)
+
+    def take(self, xid):
+        """Removes the transaction from running and spilled. Returns its
+        Running, or None."""
+        entry = self.running.pop(xid, None)
+        spilled = self.unspill(xid)
+        if spilled is not None:
+            if entry is None:
+                entry = spilled
+            else:
+                entry.merge(spilled)
+        return entry
+
+    def current(self):
+        """running with the spilled transactions merged in."""
+        if not self.spilled.counts:
+            return self.running
+        current = {xid: Running(self.spilled_lsn[xid], count - error)
+                   for xid, (count, error) in self.spilled.counts.items()}
+        for xid, entry in self.running.items():
+            if xid in current:
+                current[xid].merge(entry)
+            else:
+                current[xid] = entry
+        return current
+
+    def prune(self, horizon):
+        """Drops the running and spilled transactions older than horizon."""
+        for running in (self.running, self.spilled.counts):
+            ended = [xid for xid in running if xid_precedes(int(xid), horizon)]
+            for xid in ended:
+                del running[xid]
+            self.pruned += len(ended)
+        self.trim_lsns()
+
+    def running_xacts(self, rest):
+        horizon = oldest_running(rest)
+        # Transactions older than an unchanged horizon ended before it was
+        # seen, so there is nothing new to prune
+        if horizon is not None and horizon != self.horizon:
+            self.horizon = horizon
+            self.prune(horizon)
+
+    def end(self, xid, rest):
+        """Removes the transaction and its subxacts from running. Returns the
+        subxids, and the xid and merged Running of the first of them that
+        was running."""
+        running = self.running
+        spilled = self.spilled.counts
+        entry = self.take(xid) if spilled else running.pop(xid, None)
+        i = rest.find(b'subxacts: ')
+        if i < 0:
+            return (), xid, entry
+        j = rest.find(b';', i)
+        xids = tuple([subxid.rjust(XID_WIDTH)
+                      for subxid in rest[i + 10:j if j >= 0 else len(rest)].split()])
+        first = xid
+        for subxid in xids:
+            if subxid not in running and subxid not in spilled:
                 continue
-            other = running.pop(xid)
-            if stat is None:
-                stat = other
+            other = self.take(subxid)
+            if entry is None:
+                first, entry = subxid, other
             else:
-                stat.merge(other)
-        if stat is not None and stat.num_updates > topN[0][0]:
-            stat.commit_lsn = lsn
-            stat.commit_time = rest.split(';', 1)[0]
-            heapq.heappushpop(topN, (stat.num_updates, stat))
-        last_lsn = lsn
-    if (i % 1000000) == 999999:
-        print_stats(lsn, topN)
-        print_running(running)
-
-print_stats(last_lsn, topN)
+                entry.merge(other)
+        return xids, first, entry
+
+    def push(self, xid, entry, lsn, commit_time):
+        if entry.num_updates > self.topN[0][0]:
+            stat = entry.stats(xid)
+            stat.commit_lsn = lsn.decode()
+            stat.commit_time = commit_time.decode()
+            heapq.heappushpop(self.topN, (stat.num_updates, stat))
+
+    def commit(self, xid, lsn, rest):
+        subxids, first, entry = self.end(xid, rest)
+        if self.commits is not None:
+            # Modifications can be in earlier shards, so keep them all
+            packed = None if entry is None else (first, entry.first_lsn, entry.num_updates)
+            self.commits.append((xid, subxids, packed, lsn, rest.split(b';', 1)[0]))
+        elif entry is not None and entry.num_updates > self.topN[0][0]:
+            self.push(first, entry, lsn, rest.split(b';', 1)[0])
+        self.last_lsn = lsn
+
+    def abort(self, xid, lsn, rest):
+        subxids, first, entry = self.end(xid, rest)
+        if self.commits is not None:
+            # Ends the transaction also in earlier shards
+            self.commits.append((xid, subxids, None, lsn, None))
+
+    def feed(self, lines):
+        """Adds the pg_waldump lines. The lines that matter are picked by
+        their fixed width rmgr prefix and most of them are handled right
+        here, the rest goes through parse_line."""
+        running = self.running
+        max_running = self.max_running
+        for line in lines:
+            head = line[:11]
+            if head == b"rmgr: Heap ":
+                d = line.find(DESC_SEP, 69)
+                if d >= 0 and not line.startswith(MOD_PREFIXES, d + 8):
+                    continue
+                if d < 0 or line[46:52] != TX_SEP:
+                    self.add(*(parse_slow(line) or bad_line(line)))
+                    continue
+                xid = line[52:62]
+                entry = running.get(xid)
+                if entry is not None:
+                    entry.num_updates += 1
+                    continue
+                # modify(), inlined
+                running[xid] = Running(line[69:line.find(b",", 69)], 1)
+                if max_running and len(running) > max_running:
+                    self.evict()
+            elif head == b"rmgr: Trans":
+                d = line.find(DESC_SEP, 69)
+                if d >= 0 and not line.startswith(END_PREFIXES, d + 8):
+                    continue
+                if d < 0 or line[46:52] != TX_SEP:
+                    self.add(*(parse_slow(line) or bad_line(line)))
+                elif line.startswith(b"COMMIT ", d + 8):
+                    self.commit(line[52:62], line[69:line.find(b",", 69)], line[d+15:])
+                else:
+                    self.abort(line[52:62], line[69:line.find(b",", 69)], line[d+14:])
+            elif head == b"rmgr: Stand":
+                if b"RUNNING_XACTS " in line:
+                    self.add(*(parse_line(line) or bad_line(line)))
+            elif head[:6] != b"rmgr: ":
+                self.add(*(parse_slow(line) or bad_line(line)))
+
+def line_lsn(line):
+    parsed = parse_line(line)
+    return parsed[2].decode() if parsed else None
+
+def analyze(batches, tracker, parse=None):
+    """Feeds the lines in batches to tracker, printing the stats every
+    REPORT_EVERY lines. With parse, lines are parsed with it one by one."""
+    nlines = 0
+    for lines in batches:
+        while lines:
+            # Split batches to report at the exact line
+            split = REPORT_EVERY - nlines % REPORT_EVERY
+            lines, rest_lines = lines[:split], lines[split:]
+            feed_lines(tracker, lines, parse)
+            nlines += len(lines)
+            if nlines % REPORT_EVERY == 0:
+                print_stats(line_lsn(lines[-1]), tracker.topN)
+                print_running(tracker.current())
+            lines = rest_lines
+    return tracker.last_lsn.decode() if tracker.last_lsn is not None else None
+
+def feed_lines(tracker, lines, parse=None):
+    if tracker.blocks is not None:
+        tracker.blocks.feed(lines)
+    if parse is None:
+        tracker.feed(lines)
+    else:
+        for line in lines:
+            tracker.add(*(parse(line) or bad_line(line)))
+
+def shards(paths, shard_size=SHARD_SIZE):
+    """Splits the files into (path, offset, length) of about shard_size
+    bytes, starting at line boundaries."""
+    result = []
+    for path in paths:
+        size = os.path.getsize(path)
+        offsets = [0]
+        with open(path, 'rb') as fd:
+            for offset in range(shard_size, size, shard_size):
+                if offset <= offsets[-1]:
+                    continue
+                fd.seek(offset)
+                fd.readline()
+                if fd.tell() < size:
+                    offsets.append(fd.tell())
+        offsets.append(size)
+        result.extend((path, start, end - start)
+                      for start, end in zip(offsets, offsets[1:]) if end > start)
+    return result
+
+ShardResult = namedtuple("ShardResult", [
+    'running', 'commits', 'index', 'ranked', 'last_lsn',
+    'horizon', 'pruned', 'evicted', 'spilled', 'spilled_lsn', 'blocks'
+])
+
+def analyze_shard(task):
+    """Pool worker. Returns the transactions still running at the end of
+    the shard, all commits and aborts, an index of them by xid and subxids,
+    and the commits with modifications ranked by them. Running entries go
+    as tuples, which pickle several times faster."""
+    path, offset, length, parse, max_running, sketch_size = task
+    blocks = BlockStats(sketch_size) if sketch_size else None
+    tracker = Tracker(keep_commits=True, max_running=max_running, blocks=blocks)
+    with open(path, 'rb') as fd:
+        fd.seek(offset)
+        for lines in read_lines(fd, length=length):
+            feed_lines(tracker, lines, parse)
+    commits = tracker.commits
+    index = {}
+    for i, (xid, subxids, packed, lsn, commit_time) in enumerate(commits):
+        index[xid] = i
+        for subxid in subxids:
+            index[subxid] = i
+    # Stable, so ties stay in commit order
+    ranked = sorted((i for i, commit in enumerate(commits) if commit[2] is not None),
+                    key=lambda i: commits[i][2][2], reverse=True)
+    running = {xid: (entry.first_lsn, entry.num_updates)
+               for xid, entry in tracker.running.items()}
+    return ShardResult(running, commits, index, ranked, tracker.last_lsn, tracker.horizon,
+                       tracker.pruned, tracker.evicted, tracker.spilled, tracker.spilled_lsn,
+                       blocks)
+
+def merge_shards(results, n=N, max_running=None, blocks=None):
+    """Merges the ShardResults of consecutive shards into a Tracker.
+
+    Transactions running or spilled at the end of a shard are carried into
+    the next ones, and added to their commit when the commit or one of its subxacts
+    shows up in a later shard's index. Of the other commits of a shard only
+    its top n by modifications can make it into the top n overall."""
+    tracker = Tracker(n, max_running=max_running, blocks=blocks)
+    carried = tracker.running
+    for result in results:
+        spilled = tracker.spilled.counts
+        matched = {}
+        for xid in (carried.keys() | spilled.keys()) & result.index.keys():
+            matched.setdefault(result.index[xid], []).append(xid)
+        candidates = []
+        for i, xids in matched.items():
+            xid, subxids, packed, lsn, commit_time = result.commits[i]
+            parts = [(x, tracker.take(x)) for x in xids]
+            if commit_time is None:
+                continue
+            if packed is not None:
+                parts.append((packed[0], Running(packed[1], packed[2])))
+            # Merged in the order of Tracker.end
+            order = (xid,) + subxids
+            parts.sort(key=lambda part: order.index(part[0]))
+            first, entry = parts[0]
+            for x, other in parts[1:]:
+                entry.merge(other)
+            candidates.append((i, first, entry))
+        taken = 0
+        for i in result.ranked:
+            if taken == n:
+                break
+            if i not in matched:
+                packed = result.commits[i][2]
+                candidates.append((i, packed[0], Running(packed[1], packed[2])))
+                taken += 1
+        candidates.sort(key=lambda candidate: candidate[0])
+        for i, first, entry in candidates:
+            xid, subxids, packed, lsn, commit_time = result.commits[i]
+            tracker.push(first, entry, lsn, commit_time)
+        for xid, (first_lsn, num_updates) in result.running.items():
+            entry = carried.get(xid)
+            if entry is None:
+                carried[xid] = Running(first_lsn, num_updates)
+            else:
+                entry.merge(Running(first_lsn, num_updates))
+        for xid, first_lsn in result.spilled_lsn.items():
+            tracker.spill_lsn(xid, first_lsn)
+        tracker.spilled.merge(result.spilled)
+        tracker.trim_lsns()
+        if result.horizon is not None:
+            tracker.prune(result.horizon)
+        if max_running and len(carried) > max_running:
+            tracker.evict()
+        tracker.pruned += result.pruned
+        tracker.evicted += result.evicted
+        if blocks is not None:
+            blocks.merge(result.blocks)
+        if result.last_lsn is not None:
+            tracker.last_lsn = result.last_lsn
+    return tracker
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] [waldump.txt ...] (default: stdin)")
+    parser.add_option("--regex", dest="regex", action="store_true", default=False,
+                      help="Parse every line with the regular expression, skipping the fast path")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="Analyze the files in shards using JOBS processes")
+    parser.add_option("--shard-size", dest="shard_size", type="int", default=SHARD_SIZE >> 20,
+                      help="Size of the shards in MB with --jobs [default: %default]")
+    parser.add_option("--max-running", dest="max_running", type="int", default=None,
+                      help="Track at most this many running transactions, and keep a "
+                           "summary of at most as many evicted ones. Updates can then "
+                           "be short by up to the bound printed at the end")
+    parser.add_option("--relations", dest="relations", type="int", default=0,
+                      help="Also print the top RELATIONS relations and blocks by "
+                           "records and full page image bytes")
+    parser.add_option("--sketch-size", dest="sketch_size", type="int", default=SKETCH_SIZE,
+                      help="Relations and blocks counted for --relations [default: %default]")
+    (options, args) = parser.parse_args()
+    parse = parse_slow if options.regex else None
+    sketch_size = max(options.sketch_size, options.relations) if options.relations else None
+    blocks = BlockStats(sketch_size) if sketch_size else None
+
+    if options.jobs > 1 and not args:
+        print("--jobs needs pg_waldump output files")
+        sys.exit(1)
+
+    try:
+        if options.jobs > 1:
+            tasks = [task + (parse, options.max_running, sketch_size)
+                     for task in shards(args, options.shard_size << 20)]
+            with multiprocessing.Pool(options.jobs) as pool:
+                tracker = merge_shards(pool.imap(analyze_shard, tasks),
+                                       max_running=options.max_running, blocks=blocks)
+            last_lsn = tracker.last_lsn.decode() if tracker.last_lsn is not None else None
+        else:
+            tracker = Tracker(max_running=options.max_running, blocks=blocks)
+            if args:
+                batches = read_files(args)
+            else:
+                batches = read_lines(sys.stdin.buffer)
+            last_lsn = analyze(batches, tracker, parse)
+    except BadLine as e:
+        print(e)
+        sys.exit(1)
+    print_stats(last_lsn, tracker.topN)
+    if tracker.evicted:
+        print(f"Evicted {tracker.evicted} running transactions, updates can be "
+              f"short by up to {tracker.spilled.floor}")
+    if blocks is not None:
+        print_blocks(blocks, options.relations)
+
+if __name__ == "__main__":
+    main()
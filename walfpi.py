@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""Extracts full page images from WAL in one pass.
+
+Every backup block of every record is appended to a page store per relation
+fork, with its hole filled back in. An in-memory index keeps the newest
+image of each block, written next to the store when done. The newest
+images can also be laid out as relation files, ready to be copied over a
+damaged relation."""
+from collections import namedtuple
+import os
+import struct
+import sys
+
+import xlogfilter
+from xlogfilter import RelFileNode
+
+BLCKSZ = 8192
+# Blocks per relation segment file
+RELSEG_SIZE = 131072
+
+FORK_NAMES = ["", "_fsm", "_vm", "_init"]
+
+STORE_SUFFIX = ".fpi"
+MAP_SUFFIX = ".map"
+# Every page in a store is preceded by its block number and the lsn of the
+# record it came from
+PAGE_HEADER = struct.Struct("<IQ")
+# Rows of the map file: block, lsn and offset of the page in the store
+MAP_ROW = struct.Struct("<IQQ")
+
+PageImage = namedtuple("PageImage", ['lsn', 'offset'])
+
+ZERO_PAGE = bytes(BLCKSZ)
+
+def restore_hole(block, contents):
+    """The full page of a backup block, or None if it doesn't add up."""
+    if (block.hole_offset + block.hole_length > BLCKSZ or
+            len(contents) != BLCKSZ - block.hole_length):
+        return None
+    if not block.hole_length:
+        return bytes(contents)
+    return b"".join((contents[:block.hole_offset], ZERO_PAGE[:block.hole_length],
+                     contents[block.hole_offset:]))
+
+class PageStore(object):
+    """Append-only file of the page images of one relation fork, with the
+    newest image of each block indexed in memory."""
+    def __init__(self, path, node, fork):
+        self.path = path
+        self.node = node
+        self.fork = fork
+        self.index = {}
+        self.size = 0
+        self.fd = None
+
+    @property
+    def fork_suffix(self):
+        if self.fork < len(FORK_NAMES):
+            return FORK_NAMES[self.fork]
+        return "_%d" % self.fork
+
+    @property
+    def name(self):
+        return "%d_%d_%d%s" % (self.node.spcNode, self.node.dbNode, self.node.relNode,
+                               self.fork_suffix)
+
+    def store_path(self):
+        return os.path.join(self.path, self.name + STORE_SUFFIX)
+
+    def append(self, blkno, lsn, page):
+        if self.fd is None:
+            # Only reopened for appending if closed to save file handles
+            self.fd = open(self.store_path(), 'ab' if self.size else 'wb')
+        self.fd.write(PAGE_HEADER.pack(blkno, lsn))
+        self.fd.write(page)
+        # Records come in lsn order, so the last image is the newest
+        self.index[blkno] = PageImage(lsn, self.size + PAGE_HEADER.size)
+        self.size += PAGE_HEADER.size + BLCKSZ
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def save_map(self):
+        with open(os.path.join(self.path, self.name + MAP_SUFFIX), 'wb') as fd:
+            for blkno in sorted(self.index):
+                image = self.index[blkno]
+                fd.write(MAP_ROW.pack(blkno, image.lsn, image.offset))
+
+    def materialize(self, outdir):
+        """Writes the newest images as relation files under
+        outdir/spcoid/dboid, leaving blocks without an image sparse."""
+        reldir = os.path.join(outdir, str(self.node.spcNode), str(self.node.dbNode))
+        if not os.path.isdir(reldir):
+            os.makedirs(reldir)
+        relname = "%d%s" % (self.node.relNode, self.fork_suffix)
+        outputs = {}
+        try:
+            with open(self.store_path(), 'rb') as store:
+                for blkno in sorted(self.index):
+                    relseg = blkno // RELSEG_SIZE
+                    if relseg not in outputs:
+                        path = os.path.join(reldir, relname + (".%d" % relseg if relseg else ""))
+                        outputs[relseg] = open(path, 'wb')
+                    store.seek(self.index[blkno].offset)
+                    out = outputs[relseg]
+                    out.seek((blkno % RELSEG_SIZE) * BLCKSZ)
+                    out.write(store.read(BLCKSZ))
+        finally:
+            for out in outputs.values():
+                out.close()
+
+class Extractor(object):
+    """Collects the backup blocks of the records fed to it. With nodes only
+    those relations are kept."""
+    def __init__(self, path, nodes=None):
+        self.path = path
+        self.nodes = nodes
+        self.stores = {}
+        self.nimages = 0
+        self.nbad = 0
+        self.open_stores = []
+
+    def add(self, rec):
+        if not rec.num_blocks or rec.blockdata is None:
+            return
+        for block, contents in rec.blocks:
+            if self.nodes and block.node not in self.nodes:
+                continue
+            page = restore_hole(block, contents)
+            if page is None:
+                self.nbad += 1
+                continue
+            key = (block.node, block.fork)
+            store = self.stores.get(key)
+            if store is None:
+                store = self.stores[key] = PageStore(self.path, block.node, block.fork)
+            if store.fd is None:
+                self.open_stores.append(store)
+                if len(self.open_stores) > 256:
+                    # Stay well away from the open files limit
+                    self.open_stores.pop(0).close()
+            store.append(block.block, rec.lsn, page)
+            self.nimages += 1
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+            store.save_map()
+
+def extract(path, tli, seg, outdir, nodes=None, start_lsn=None, end_lsn=None):
+    """Extracts the images of the records from seg, or start_lsn, on up to
+    end_lsn."""
+    extractor = Extractor(outdir, nodes)
+    for rec in xlogfilter.records(path, tli, seg, start_lsn=start_lsn, end_lsn=end_lsn):
+        extractor.add(rec)
+    extractor.close()
+    return extractor
+
+from optparse import OptionParser
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] startseg outdir")
+    parser.add_option("-n", "--node", dest="nodes", action="append", type="string",
+                      help="Only extract a filenode. Format: tablespaceoid,databaseoid,filenode")
+    parser.add_option("--start-lsn", dest="start_lsn",
+                      help="Start at the first record starting at or after LSN (X/X), "
+                           "in the segment holding it instead of startseg")
+    parser.add_option("--end-lsn", dest="end_lsn",
+                      help="Stop at the first record starting at or after LSN (X/X)")
+    parser.add_option("-m", "--materialize", dest="materialize", metavar="DIR",
+                      help="Also write the newest image of every block as relation files under DIR")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_usage()
+        sys.exit(1)
+
+    nodes = set()
+    for node in options.nodes or []:
+        match = xlogfilter.filenode_re.match(node)
+        if not match:
+            print("Invalid filenode %s" % node)
+            sys.exit(1)
+        nodes.add(RelFileNode(*map(int, match.groups())))
+    start_lsn = xlogfilter.parse_lsn(options.start_lsn) if options.start_lsn else None
+    end_lsn = xlogfilter.parse_lsn(options.end_lsn) if options.end_lsn else None
+
+    start_file, outdir = args
+    tli, seg = xlogfilter.parse_xlog_filename(os.path.basename(start_file))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    extractor = extract(os.path.dirname(start_file) or ".", tli, seg, outdir, nodes,
+                        start_lsn, end_lsn)
+    npages = sum(len(store.index) for store in extractor.stores.values())
+    print("Extracted %d page images, newest %d pages of %d relation forks%s" % (
+        extractor.nimages, npages, len(extractor.stores),
+        ", %d damaged images skipped" % extractor.nbad if extractor.nbad else ""))
+    if options.materialize:
+        for store in extractor.stores.values():
+            store.materialize(options.materialize)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+"""Synthetic pre-9.5 WAL for testing and benchmarking the WAL tools.
+
+Writes segments of valid legacy format WAL: long and short page headers,
+records spanning pages with the continuation length set, heap and btree
+records on a weighted mix of relfilenodes, some of them with a full page
+image, commits, and optionally an XLOG_SWITCH every few segments. The
+output only depends on the seed, so numbers taken on it can be
+reproduced."""
+from collections import namedtuple
+import os
+import random
+import struct
+import sys
+
+import crc32
+import xlogfilter
+from xlogfilter import (RelFileNode, XLOG_SIZE, XLOG_BLCKSZ, RECORD_HEADER_LEN,
+                        HEADER_LEN, LONG_HEADER_LEN,
+                        RECORD_STRUCT, RELFILENODE_STRUCT, BKP_BLOCK_STRUCT,
+                        LONG_HEADER_STRUCT, SHORT_HEADER_STRUCT, I,
+                        RM_XLOG_ID, RM_XACT_ID, RM_HEAP_ID, RM_BTREE_ID)
+
+# 9.4
+XLOG_PAGE_MAGIC = 0xD07E
+XLP_FIRST_IS_CONTRECORD = 0x0001
+XLP_LONG_HEADER = 0x0002
+# Backup block flag of the first block in the record info
+XLR_BKP_BLOCK_1 = 0x08
+
+DEFAULT_NODES = [RelFileNode(1663, 12345, 16384), RelFileNode(1663, 12345, 16390),
+                 RelFileNode(1663, 12345, 16392), RelFileNode(1663, 16401, 16410)]
+
+GenResult = namedtuple("GenResult", ['segments', 'records', 'fpis', 'switches', 'end_lsn'])
+
+def random_bytes(rng, n):
+    return rng.getrandbits(8*n).to_bytes(n, 'little') if n else b""
+
+def make_record(rmid, info, xid, prev, rmdata, blocks=()):
+    """A complete record with its CRC. blocks are (BkpBlock, page) with the
+    hole of the page left out of the record."""
+    body = [bytes(rmdata)]
+    for i, (block, page) in enumerate(blocks):
+        info |= XLR_BKP_BLOCK_1 >> i
+        node = block.node
+        body.append(BKP_BLOCK_STRUCT.pack(node.spcNode, node.dbNode, node.relNode,
+                                          block.fork, block.block,
+                                          block.hole_offset, block.hole_length))
+        body.append(page[:block.hole_offset])
+        body.append(page[block.hole_offset + block.hole_length:])
+    body = b"".join(body)
+    header = bytearray(RECORD_HEADER_LEN)
+    RECORD_STRUCT.pack_into(header, 0, RECORD_HEADER_LEN + len(body), xid, len(rmdata),
+                            info, rmid, prev, 0)
+    crc = crc32.PGCRC32(body)
+    crc.update(header[0:24])
+    struct.pack_into("I", header, 24, crc.digest())
+    return bytes(header) + body
+
+class SegmentBuilder(object):
+    """Lays records out on pages, writing each segment out once full."""
+    def __init__(self, outdir, tli, seg, magic=XLOG_PAGE_MAGIC, sysid=6000000000000000000):
+        self.outdir = outdir
+        self.tli = tli
+        self.magic = magic
+        self.sysid = sysid
+        self.pos = seg*XLOG_SIZE
+        self.data = bytearray(XLOG_SIZE)
+        self.nsegs = 0
+
+    @property
+    def offset(self):
+        return self.pos % XLOG_SIZE
+
+    def page_header(self, rem_len):
+        info = XLP_FIRST_IS_CONTRECORD if rem_len else 0
+        if self.offset == 0:
+            header = LONG_HEADER_STRUCT.pack(self.magic, info | XLP_LONG_HEADER, self.tli,
+                                             self.pos, rem_len, self.sysid, XLOG_SIZE, XLOG_BLCKSZ)
+        else:
+            header = SHORT_HEADER_STRUCT.pack(self.magic, info, self.tli, self.pos, rem_len)
+        self.data[self.offset:self.offset+len(header)] = header
+        # The short header is padded to HEADER_LEN
+        self.pos += LONG_HEADER_LEN if self.offset == 0 else HEADER_LEN
+
+    def put(self, data):
+        done = 0
+        while done < len(data):
+            if self.pos % XLOG_BLCKSZ == 0:
+                self.page_header(len(data) - done if done else 0)
+            n = min(XLOG_BLCKSZ - self.pos % XLOG_BLCKSZ, len(data) - done)
+            self.data[self.offset:self.offset+n] = data[done:done+n]
+            self.pos += n
+            done += n
+            if self.offset == 0:
+                self.flush()
+
+    def align(self):
+        # Page headers keep pages 8 aligned, so padding never crosses one
+        self.pos = xlogfilter.align8(self.pos)
+
+    def skip_segment(self):
+        """Leaves the rest of the segment empty, as after an XLOG_SWITCH."""
+        while self.offset:
+            if self.pos % XLOG_BLCKSZ == 0:
+                self.page_header(0)
+            self.pos = (self.pos | (XLOG_BLCKSZ - 1)) + 1
+            if self.offset == 0:
+                self.flush()
+
+    def flush(self):
+        seg = (self.pos - 1) // XLOG_SIZE
+        path = os.path.join(self.outdir, "%08X%08X%08X" % (self.tli, seg >> 8, seg & 0xFF))
+        with open(path, 'wb') as fd:
+            fd.write(self.data)
+        self.data[:] = bytes(XLOG_SIZE)
+        self.nsegs += 1
+
+    def finish(self):
+        """Ends WAL at pos, the rest of the segment stays zeroed."""
+        if self.offset:
+            if self.pos % XLOG_BLCKSZ == 0:
+                self.page_header(0)
+            self.pos = ((self.pos - 1) | (XLOG_SIZE - 1)) + 1
+            self.flush()
+
+def make_page(rng):
+    """A page with pd_lower/pd_upper set and the hole between them zeroed."""
+    lower = 24 + 4*rng.randint(1, 200)
+    upper = rng.randint(lower + 8, XLOG_BLCKSZ - 64) & ~7
+    page = bytearray(random_bytes(rng, XLOG_BLCKSZ))
+    struct.pack_into("HH", page, 12, lower, upper)
+    page[lower:upper] = bytes(upper - lower)
+    return bytes(page), lower, upper - lower
+
+def generate(outdir, nsegs=4, seed=1, nodes=DEFAULT_NODES, weights=None, fpi=0.1,
+             switch_every=0, tli=1, seg=1, xacts_len=(1, 8)):
+    """Writes nsegs segments of WAL from segment seg on. Transactions of
+    xacts_len heap and btree records on nodes, chosen by weights, are ended
+    by a commit. A fraction fpi of the records carries a full page image.
+    With switch_every, every switch_every-th segment is switched halfway."""
+    rng = random.Random(seed)
+    out = SegmentBuilder(outdir, tli, seg)
+    end = (seg + nsegs)*XLOG_SIZE
+    prev = 0
+    xid = 1000
+    nrecs = nfpis = nswitches = 0
+    switched = set()
+    # Room for the largest transaction generated
+    margin = (xacts_len[1] + 2)*2*XLOG_BLCKSZ
+    while out.pos + margin < end:
+        xact = []
+        for i in range(rng.randint(*xacts_len)):
+            node = rng.choices(nodes, weights)[0]
+            blkno = rng.randrange(1000)
+            blocks = []
+            if rng.random() < fpi:
+                page, hole_offset, hole_length = make_page(rng)
+                blocks.append((xlogfilter.BkpBlock(node, 0, blkno, hole_offset, hole_length), page))
+            if rng.random() < 0.7:
+                # xl_heap_insert: target node and tid, flags, xl_heap_header, tuple
+                rmid, info = RM_HEAP_ID, rng.choice([I["XLOG_HEAP_INSERT"], I["XLOG_HEAP_INSERT"],
+                                                     I["XLOG_HEAP_DELETE"], I["XLOG_HEAP_HOT_UPDATE"]])
+                if info == I["XLOG_HEAP_INSERT"] and blkno % 64 == 0:
+                    # First insert on a new page, with XLOG_HEAP_INIT_PAGE
+                    info |= I["XLOG_HEAP_INIT_PAGE"]
+                rmdata = (RELFILENODE_STRUCT.pack(*node) +
+                          struct.pack("HHHB", blkno >> 16, blkno & 0xFFFF, rng.randint(1, 200), 0) +
+                          random_bytes(rng, rng.randint(5, 300)))
+            else:
+                # xl_btree_insert: target node and block, index tuple
+                rmid, info = RM_BTREE_ID, I["XLOG_BTREE_INSERT_LEAF"]
+                rmdata = (RELFILENODE_STRUCT.pack(*node) + struct.pack("I", blkno) +
+                          random_bytes(rng, rng.randint(16, 64)))
+            xact.append((rmid, info, rmdata, blocks))
+            nfpis += len(blocks)
+        # xl_xact_commit_compact: xact_time, no subtransactions
+        xact.append((RM_XACT_ID, I["XLOG_XACT_COMMIT_COMPACT"],
+                     struct.pack("qi", rng.randrange(1 << 50), 0), ()))
+
+        for rmid, info, rmdata, blocks in xact:
+            out.align()
+            lsn = out.pos
+            out.put(make_record(rmid, info, xid, prev, rmdata, blocks))
+            prev = lsn
+            nrecs += 1
+        xid += 1
+
+        segno = out.pos // XLOG_SIZE
+        if (switch_every and (segno - seg + 1) % switch_every == 0 and segno not in switched
+                and out.offset > XLOG_SIZE // 2 and out.pos + margin < end):
+            switched.add(segno)
+            out.align()
+            lsn = out.pos
+            out.put(make_record(RM_XLOG_ID, I["XLOG_SWITCH"], 0, prev, b""))
+            prev = lsn
+            nrecs += 1
+            nswitches += 1
+            out.skip_segment()
+    end_lsn = out.pos
+    out.finish()
+    return GenResult(out.nsegs, nrecs, nfpis, nswitches, end_lsn)
+
+from optparse import OptionParser
+
+def parse_node(text):
+    """spc,db,rel with an optional :weight."""
+    node, _, weight = text.partition(":")
+    match = xlogfilter.filenode_re.match(node)
+    if not match:
+        raise ValueError(text)
+    return RelFileNode(*map(int, match.groups())), float(weight or 1)
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] outdir")
+    parser.add_option("-n", "--segments", dest="segments", type="int", default=4,
+                      help="Number of segments to write [default: %default]")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="Random seed [default: %default]")
+    parser.add_option("--node", dest="nodes", action="append", type="string",
+                      help="Relation to write records for, repeatable. "
+                           "Format: tablespaceoid,databaseoid,filenode[:weight]")
+    parser.add_option("--fpi", dest="fpi", type="float", default=0.1,
+                      help="Fraction of records with a full page image [default: %default]")
+    parser.add_option("--switch-every", dest="switch_every", type="int", default=0,
+                      help="Switch every N-th segment halfway through")
+    parser.add_option("--timeline", dest="tli", type="int", default=1,
+                      help="Timeline of the segments [default: %default]")
+    parser.add_option("--start-seg", dest="seg", type="int", default=1,
+                      help="Number of the first segment [default: %default]")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    nodes, weights = DEFAULT_NODES, None
+    if options.nodes:
+        try:
+            nodes, weights = zip(*map(parse_node, options.nodes))
+        except ValueError as e:
+            print("Invalid filenode %s" % e)
+            sys.exit(1)
+
+    outdir = args[0]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    result = generate(outdir, options.segments, options.seed, list(nodes), weights,
+                      options.fpi, options.switch_every, options.tli, options.seg)
+    print("Wrote %d segments to %s: %d records, %d full page images, %d switches, end of WAL at %s" % (
+        result.segments, outdir, result.records, result.fpis, result.switches,
+        xlogfilter.format_lsn(result.end_lsn)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""Per-segment record index for WAL archives.
+
+Scanning WAL to find one record is slow, so this builds a sidecar file per
+segment with one row per record: start lsn, rmid, info, xid, tot_len and the
+first RelFileNode the record touches. Rows are kept column-wise in arrays,
+which keeps the files compact and lookups by lsn a binary search. The
+header has the xid range and the relations of the segment, so lookups by
+xid or node skip the segments that cannot have them without loading
+them."""
+from array import array
+import bisect
+from collections import namedtuple
+import os
+import struct
+import sys
+
+import xlogfilter
+from xlogfilter import RelFileNode, XLOG_SIZE
+
+IndexEntry = namedtuple("IndexEntry", [
+    'lsn', 'rmid', 'info', 'xid', 'tot_len', 'node'
+])
+
+INDEX_MAGIC = b"PGWI"
+INDEX_VERSION = 2
+# magic, version, rows, smallest and largest nonzero xid, number of nodes,
+# followed by the nodes
+INDEX_HEADER = struct.Struct("<4sIIIII")
+NODE_STRUCT = struct.Struct("<III")
+INDEX_SUFFIX = ".idx"
+
+NO_NODE = RelFileNode(0, 0, 0)
+
+COLUMNS = [
+    ('lsn', 'Q'),
+    ('rmid', 'B'),
+    ('info', 'B'),
+    ('xid', 'I'),
+    ('tot_len', 'I'),
+    ('spc', 'I'),
+    ('db', 'I'),
+    ('rel', 'I'),
+]
+
+IndexSummary = namedtuple("IndexSummary", ['count', 'xid_min', 'xid_max', 'nodes'])
+
+def index_path(indexdir, tli, seg):
+    return "%s/%08X%08X%08X%s" % (indexdir, tli, seg>>8, seg&0xFF, INDEX_SUFFIX)
+
+def find_all(col, value):
+    """Positions of value in the array col. Searches the raw bytes, which
+    runs in C, and keeps the matches aligned to an item."""
+    data = col.tobytes()
+    needle = array(col.typecode, [value]).tobytes()
+    size = col.itemsize
+    i = data.find(needle)
+    while i >= 0:
+        if i % size == 0:
+            yield i // size
+            i = data.find(needle, i + size)
+        else:
+            i = data.find(needle, i + 1)
+
+def read_summary(fd, path):
+    magic, version, count, xid_min, xid_max, nnodes = INDEX_HEADER.unpack(fd.read(INDEX_HEADER.size))
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise ValueError("%s is not a version %d WAL index" % (path, INDEX_VERSION))
+    nodes = frozenset(RelFileNode(*node) for node in
+                      NODE_STRUCT.iter_unpack(fd.read(nnodes*NODE_STRUCT.size)))
+    return IndexSummary(count, xid_min, xid_max, nodes)
+
+class SegmentIndex(object):
+    def __init__(self):
+        for name, code in COLUMNS:
+            setattr(self, name, array(code))
+
+    def __len__(self):
+        return len(self.lsn)
+
+    def append(self, lsn, rmid, info, xid, tot_len, node):
+        self.lsn.append(lsn)
+        self.rmid.append(rmid)
+        self.info.append(info)
+        self.xid.append(xid)
+        self.tot_len.append(tot_len)
+        self.spc.append(node.spcNode)
+        self.db.append(node.dbNode)
+        self.rel.append(node.relNode)
+
+    def entry(self, i):
+        return IndexEntry(self.lsn[i], self.rmid[i], self.info[i], self.xid[i],
+                          self.tot_len[i],
+                          RelFileNode(self.spc[i], self.db[i], self.rel[i]))
+
+    def find_lsn(self, lsn):
+        """Position of the record containing lsn, or None when lsn is
+        before the first one, in padding or past the end of the last."""
+        i = bisect.bisect_right(self.lsn, lsn) - 1
+        if i < 0:
+            return None
+        # Records crossing pages also span the page headers in between
+        start, length = xlogfilter.data_ranges(self.lsn[i], self.tot_len[i])[-1]
+        if lsn >= start + length:
+            return None
+        return i
+
+    def find_node(self, node):
+        spc, db = self.spc, self.db
+        for i in find_all(self.rel, node.relNode):
+            if db[i] == node.dbNode and spc[i] == node.spcNode:
+                yield i
+
+    def find_xid(self, xid):
+        return find_all(self.xid, xid)
+
+    def summary(self):
+        xids = [xid for xid in set(self.xid) if xid]
+        return IndexSummary(len(self), min(xids, default=0), max(xids, default=0),
+                            frozenset(RelFileNode(*node) for node in set(zip(self.spc, self.db, self.rel))))
+
+    def save(self, path):
+        summary = self.summary()
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as fd:
+            fd.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, summary.count,
+                                       summary.xid_min, summary.xid_max, len(summary.nodes)))
+            for node in sorted(summary.nodes):
+                fd.write(NODE_STRUCT.pack(*node))
+            for name, code in COLUMNS:
+                getattr(self, name).tofile(fd)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with open(path, 'rb') as fd:
+            count = read_summary(fd, path).count
+            for name, code in COLUMNS:
+                getattr(index, name).fromfile(fd, count)
+        return index
+
+def record_node(rec):
+    node = rec.filenode
+    if node is None and rec.blocks:
+        node = rec.blocks[0][0].node
+    return node or NO_NODE
+
+def build(path, tli, seg, indexdir):
+    """Indexes every segment from seg on, returns the number of records."""
+    index = SegmentIndex()
+    cur_seg = seg
+    nrecs = 0
+    for rec in xlogfilter.records(path, tli, seg):
+        rec_seg = rec.lsn // XLOG_SIZE
+        if rec_seg != cur_seg:
+            index.save(index_path(indexdir, tli, cur_seg))
+            index = SegmentIndex()
+            cur_seg = rec_seg
+        h = rec.header
+        index.append(rec.lsn, h.rmid, h.info, h.xid, h.tot_len, record_node(rec))
+        nrecs += 1
+    index.save(index_path(indexdir, tli, cur_seg))
+    return nrecs
+
+class WalIndex(object):
+    """All segment indexes of one timeline in indexdir, loaded on demand."""
+    def __init__(self, indexdir, tli=1):
+        self.indexdir = indexdir
+        self.tli = tli
+        self.segments = {}
+        self.summaries = {}
+
+    def summary(self, seg):
+        """IndexSummary of the segment, reading only the header."""
+        if seg not in self.summaries:
+            path = index_path(self.indexdir, self.tli, seg)
+            with open(path, 'rb') as fd:
+                self.summaries[seg] = read_summary(fd, path)
+        return self.summaries[seg]
+
+    def segment(self, seg):
+        if seg not in self.segments:
+            path = index_path(self.indexdir, self.tli, seg)
+            self.segments[seg] = SegmentIndex.load(path) if os.path.exists(path) else None
+        return self.segments[seg]
+
+    def indexed_segments(self):
+        prefix = "%08X" % self.tli
+        segs = []
+        for name in os.listdir(self.indexdir):
+            if name.startswith(prefix) and name.endswith(INDEX_SUFFIX):
+                segs.append(xlogfilter.parse_xlog_filename(name[:-len(INDEX_SUFFIX)])[1])
+        return sorted(segs)
+
+    def find_lsn(self, lsn):
+        """The record containing lsn, assuming the archive is indexed up to
+        it. It can start in the previous segment."""
+        seg = lsn // XLOG_SIZE
+        for s in (seg, seg - 1):
+            index = self.segment(s)
+            if index is not None and len(index):
+                i = index.find_lsn(lsn)
+                if i is not None:
+                    return index.entry(i)
+        return None
+
+    def find_node(self, node):
+        for seg in self.indexed_segments():
+            if node not in self.summary(seg).nodes:
+                continue
+            index = self.segment(seg)
+            for i in index.find_node(node):
+                yield index.entry(i)
+
+    def find_xid(self, xid):
+        for seg in self.indexed_segments():
+            summary = self.summary(seg)
+            if xid and not summary.xid_min <= xid <= summary.xid_max:
+                continue
+            index = self.segment(seg)
+            for i in index.find_xid(xid):
+                yield index.entry(i)
+
+def show_entry(entry):
+    infoname = xlogfilter.INFOS.get(entry.rmid, {}).get(xlogfilter.info_op(entry.rmid, entry.info),
+                                                         entry.info)
+    return "%s %12s.%-27s xid=%d tot_len=%d node=%s" % (
+        xlogfilter.format_lsn(entry.lsn), xlogfilter.RM_NAMES[entry.rmid],
+        infoname, entry.xid, entry.tot_len, xlogfilter.show_node(entry.node))
+
+from optparse import OptionParser
+
+def main():
+    parser = OptionParser(usage="usage: %prog build startseg indexdir\n"
+                                "       %prog [options] lookup indexdir")
+    parser.add_option("--lsn", dest="lsn", help="Record containing LSN (X/X)")
+    parser.add_option("-n", "--node", dest="node",
+                      help="Records touching a filenode. Format: tablespaceoid,databaseoid,filenode")
+    parser.add_option("--xid", dest="xid", type="int", help="Records of transaction XID")
+    parser.add_option("-t", "--timeline", dest="tli", type="int", default=1,
+                      help="Timeline to look up")
+    parser.add_option("-r", "--record", dest="record", metavar="WALDIR",
+                      help="Also decode the record found by --lsn from WALDIR")
+    (options, args) = parser.parse_args()
+
+    if len(args) == 3 and args[0] == "build":
+        start_file, indexdir = args[1:]
+        tli, seg = xlogfilter.parse_xlog_filename(os.path.basename(start_file))
+        if not os.path.isdir(indexdir):
+            os.makedirs(indexdir)
+        nrecs = build(os.path.dirname(start_file) or ".", tli, seg, indexdir)
+        print("Indexed %d records" % nrecs)
+    elif len(args) == 2 and args[0] == "lookup":
+        index = WalIndex(args[1], options.tli)
+        if options.lsn:
+            entry = index.find_lsn(xlogfilter.parse_lsn(options.lsn))
+            if entry is None:
+                print("No record at %s" % options.lsn)
+                sys.exit(1)
+            print(show_entry(entry))
+            if options.record:
+                print(xlogfilter.record_at(options.record, options.tli, entry.lsn))
+        if options.node:
+            match = xlogfilter.filenode_re.match(options.node)
+            if not match:
+                print("Invalid filenode %s" % options.node)
+                sys.exit(1)
+            for entry in index.find_node(RelFileNode(*map(int, match.groups()))):
+                print(show_entry(entry))
+        if options.xid is not None:
+            for entry in index.find_xid(options.xid):
+                print(show_entry(entry))
+    else:
+        parser.print_usage()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+"""Bulk page header scan for triaging damaged WAL archives.
+
+Checks the headers of all pages of a segment at once, without decoding
+records: magic, timeline, pageaddr, the header flags and the continuation
+length that a record spanning pages carries from one page to the next.
+Uses NumPy when it is installed and a struct loop otherwise."""
+from collections import namedtuple
+import os
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import xlogfilter
+from xlogfilter import XLOG_SIZE, XLOG_BLCKSZ, HEADER_LEN, LONG_HEADER_LEN
+
+XLP_FIRST_IS_CONTRECORD = 0x0001
+XLP_LONG_HEADER = 0x0002
+
+# Order in which problems are reported
+CHECKS = ["magic", "info", "tli", "pageaddr", "rem_len", "zero"]
+
+SegmentScan = namedtuple("SegmentScan", [
+    'npages', 'bad', 'zero_from'
+])
+
+if numpy is not None:
+    HEADER_DTYPE = numpy.dtype([
+        ('magic', '=u2'),
+        ('info', '=u2'),
+        ('tli', '=u4'),
+        ('pageaddr', '=u8'),
+        ('rem_len', '=u4'),
+    ])
+
+def page_free(page):
+    """Bytes after the page header."""
+    return XLOG_BLCKSZ - (LONG_HEADER_LEN if page == 0 else HEADER_LEN)
+
+def scan_numpy(data, tli, seg, magic):
+    npages = len(data) // XLOG_BLCKSZ
+    if npages == 0:
+        return SegmentScan(0, {}, None)
+    # One strided view over all page headers, nothing is copied
+    headers = numpy.ndarray((npages,), HEADER_DTYPE, buffer=data, strides=(XLOG_BLCKSZ,))
+    pages = numpy.arange(npages)
+    info = headers['info']
+    rem_len = headers['rem_len'].astype(numpy.int64)
+    free = numpy.full(npages, XLOG_BLCKSZ - HEADER_LEN, dtype=numpy.int64)
+    free[0] = XLOG_BLCKSZ - LONG_HEADER_LEN
+    expected_addr = numpy.uint64(seg*XLOG_SIZE) + pages.astype(numpy.uint64)*numpy.uint64(XLOG_BLCKSZ)
+
+    zero = ((headers['magic'] == 0) & (info == 0) & (headers['tli'] == 0) &
+            (headers['pageaddr'] == 0) & (rem_len == 0))
+    used = numpy.nonzero(~zero)[0]
+    zero_from = int(used[-1]) + 1 if len(used) else 0
+    checked = ~zero
+
+    carried = numpy.zeros(npages, dtype=bool)
+    carried[1:] = rem_len[:-1] > free[:-1]
+    rem_bad = numpy.zeros(npages, dtype=bool)
+    rem_bad[1:] = carried[1:] & (rem_len[1:] != rem_len[:-1] - free[:-1])
+
+    masks = {
+        "magic": checked & (headers['magic'] != magic),
+        "info": checked & ((((info & XLP_LONG_HEADER) != 0) != (pages == 0)) |
+                           (((info & XLP_FIRST_IS_CONTRECORD) != 0) != (rem_len != 0))),
+        "tli": checked & (headers['tli'] != tli),
+        "pageaddr": checked & (headers['pageaddr'] != expected_addr),
+        "rem_len": checked & rem_bad,
+        "zero": zero & (pages < zero_from),
+    }
+    bad = {}
+    for check in CHECKS:
+        for page in numpy.nonzero(masks[check])[0]:
+            bad.setdefault(int(page), []).append(check)
+    return SegmentScan(npages, bad, zero_from if zero_from < npages else None)
+
+def scan_python(data, tli, seg, magic):
+    npages = len(data) // XLOG_BLCKSZ
+    headers = [xlogfilter.XLogPageHeader._make(
+                   xlogfilter.SHORT_HEADER_STRUCT.unpack_from(data, page*XLOG_BLCKSZ))
+               for page in range(npages)]
+    zero_from = 0
+    for page, header in enumerate(headers):
+        if any(header):
+            zero_from = page + 1
+
+    bad = {}
+    prev_rem = 0
+    for page, header in enumerate(headers):
+        problems = []
+        if not any(header):
+            if page < zero_from:
+                problems.append("zero")
+        else:
+            if header.magic != magic:
+                problems.append("magic")
+            if (bool(header.info & XLP_LONG_HEADER) != (page == 0) or
+                    bool(header.info & XLP_FIRST_IS_CONTRECORD) != (header.rem_len != 0)):
+                problems.append("info")
+            if header.tli != tli:
+                problems.append("tli")
+            if header.pageaddr != seg*XLOG_SIZE + page*XLOG_BLCKSZ:
+                problems.append("pageaddr")
+            if page > 0 and prev_rem > page_free(page - 1) and \
+                    header.rem_len != prev_rem - page_free(page - 1):
+                problems.append("rem_len")
+        if problems:
+            bad[page] = problems
+        prev_rem = header.rem_len
+    return SegmentScan(npages, bad, zero_from if zero_from < npages else None)
+
+def scan_segment(data, tli, seg, magic, use_numpy=True):
+    """Checks all page headers of the segment in data.
+
+    Returns a SegmentScan with the number of whole pages, a dict of page
+    number to the list of failed checks, and the first page of the zeroed
+    tail of the segment or None."""
+    if use_numpy and numpy is not None:
+        return scan_numpy(data, tli, seg, magic)
+    return scan_python(data, tli, seg, magic)
+
+def show_page(data, seg, page, problems):
+    header = xlogfilter.XLogPageHeader._make(
+        xlogfilter.SHORT_HEADER_STRUCT.unpack_from(data, page*XLOG_BLCKSZ))
+    return "    page %4d at %s: magic=%04X info=%04X tli=%d pageaddr=%s rem_len=%d [%s]" % (
+        page, xlogfilter.format_lsn(seg*XLOG_SIZE + page*XLOG_BLCKSZ),
+        header.magic, header.info, header.tli, xlogfilter.format_lsn(header.pageaddr),
+        header.rem_len, ", ".join(problems))
+
+from optparse import OptionParser
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] startseg")
+    parser.add_option("-n", "--count", dest="count", type="int",
+                      help="Scan at most COUNT segments")
+    parser.add_option("--magic", dest="magic",
+                      help="Expected page magic in hex [default: that of the first page]")
+    parser.add_option("--no-numpy", dest="numpy", action="store_false", default=True,
+                      help="Use the plain Python scanner even if NumPy is available")
+    parser.add_option("-q", "--quiet", dest="quiet", action="store_true", default=False,
+                      help="Only summarize each segment, don't list bad pages")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    path = os.path.dirname(args[0]) or "."
+    tli, seg = xlogfilter.parse_xlog_filename(os.path.basename(args[0]))
+    magic = int(options.magic, 16) if options.magic else None
+
+    start = time.time()
+    nsegs = 0
+    nbad = 0
+    while options.count is None or nsegs < options.count:
+        xlogfile = xlogfilter.segment_file(path, tli, seg)
+        if xlogfile is None:
+            break
+        filename = os.path.basename(xlogfile)
+        data = xlogfilter.map_segment(xlogfile)
+        if magic is None:
+            if len(data) < HEADER_LEN or data[0] == data[1] == 0:
+                print("Can't take the magic from %s, use --magic" % filename)
+                sys.exit(1)
+            magic = xlogfilter.SHORT_HEADER_STRUCT.unpack_from(data)[0]
+        result = scan_segment(data, tli, seg, magic, options.numpy)
+        summary = "%s: %d pages, %d bad" % (filename, result.npages, len(result.bad))
+        if len(data) != XLOG_SIZE:
+            summary += ", size %d" % len(data)
+        if result.zero_from is not None:
+            summary += ", zeroed from page %d" % result.zero_from
+        print(summary)
+        if not options.quiet:
+            for page in sorted(result.bad):
+                print(show_page(data, seg, page, result.bad[page]))
+        if result.bad or len(data) != XLOG_SIZE:
+            nbad += 1
+        del data
+        nsegs += 1
+        seg += 1
+    elapsed = max(time.time() - start, 1e-6)
+    print("Scanned %d segments in %.2fs (%s), %d with problems" % (
+        nsegs, elapsed, "numpy" if options.numpy and numpy is not None else "python", nbad))
+    if nbad:
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+"""WAL statistics read straight from the segments.
+
+Answers what generated a stretch of WAL without going through pg_waldump:
+record counts and bytes per resource manager and info, full page image
+bytes, write volume per relation, and the transactions modifying the most
+heap tuples, with subtransactions merged into their top level transaction
+like waldumpstats.py does. Output is JSON."""
+import datetime
+import heapq
+import json
+import os
+import struct
+import sys
+
+import xlogfilter
+from xlogfilter import (RM_XACT_ID, RM_HEAP_ID, RECORD_HEADER_LEN, BKP_BLOCK_HEADER_LEN,
+                        RM_NAMES, INFOS, I, XLOG_HEAP_OPMASK, HEAP_RMIDS, format_lsn)
+
+# The init flag of the heap infos, counted apart from their operation
+XLOG_HEAP_INIT_PAGE = I["XLOG_HEAP_INIT_PAGE"]
+# Heap operations counted as modifications
+HEAP_MOD_INFOS = frozenset([I["XLOG_HEAP_INSERT"], I["XLOG_HEAP_DELETE"],
+                            I["XLOG_HEAP_UPDATE"], I["XLOG_HEAP_HOT_UPDATE"]])
+
+XLOG_XACT_COMMIT = I["XLOG_XACT_COMMIT"]
+XLOG_XACT_ABORT = I["XLOG_XACT_ABORT"]
+XLOG_XACT_COMMIT_PREPARED = I["XLOG_XACT_COMMIT_PREPARED"]
+XLOG_XACT_ABORT_PREPARED = I["XLOG_XACT_ABORT_PREPARED"]
+XLOG_XACT_ASSIGNMENT = I["XLOG_XACT_ASSIGNMENT"]
+XLOG_XACT_COMMIT_COMPACT = I["XLOG_XACT_COMMIT_COMPACT"]
+
+# xl_xact_commit: xact_time, xinfo, nrels, nsubxacts, nmsgs, dbId, tsId,
+# followed by nrels RelFileNodes and the subxact xids
+XACT_COMMIT = struct.Struct("qIiiiII")
+# xl_xact_commit_compact: xact_time, nsubxacts, subxact xids
+XACT_COMMIT_COMPACT = struct.Struct("qi")
+# xl_xact_abort: xact_time, nrels, nsubxacts, RelFileNodes, subxact xids
+XACT_ABORT = struct.Struct("qii")
+# xl_xact_assignment: xtop, nsubxacts, subxact xids
+XACT_ASSIGNMENT = struct.Struct("Ii")
+# The *_PREPARED records start with the xid, the rest is 8 byte aligned
+PREPARED_XID = struct.Struct("I")
+PREPARED_LEN = 8
+
+PG_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+def format_timestamp(ts):
+    try:
+        return (PG_EPOCH + datetime.timedelta(microseconds=ts)).isoformat(" ")
+    except OverflowError:
+        return None
+
+def parse_xids(data, offset, count):
+    if count <= 0 or offset + 4*count > len(data):
+        return ()
+    return struct.unpack_from("%dI" % count, data, offset)
+
+def parse_xact_end(info, data):
+    """Returns (xact_time, subxacts) of a commit or abort record body."""
+    if info == XLOG_XACT_COMMIT_COMPACT:
+        xact_time, nsubxacts = XACT_COMMIT_COMPACT.unpack_from(data)
+        return xact_time, parse_xids(data, XACT_COMMIT_COMPACT.size, nsubxacts)
+    if info == XLOG_XACT_COMMIT:
+        xact_time, xinfo, nrels, nsubxacts, nmsgs, db, spc = XACT_COMMIT.unpack_from(data)
+        return xact_time, parse_xids(data, XACT_COMMIT.size + 12*nrels, nsubxacts)
+    xact_time, nrels, nsubxacts = XACT_ABORT.unpack_from(data)
+    return xact_time, parse_xids(data, XACT_ABORT.size + 12*nrels, nsubxacts)
+
+class XactStats(object):
+    __slots__ = ('xid', 'first_lsn', 'end_lsn', 'end_time', 'updates', 'subxacts')
+
+    def __init__(self, xid, first_lsn):
+        self.xid = xid
+        self.first_lsn = first_lsn
+        self.end_lsn = None
+        self.end_time = None
+        self.updates = 0
+        self.subxacts = 0
+
+    def merge(self, other):
+        self.first_lsn = min(self.first_lsn, other.first_lsn)
+        self.updates += other.updates
+        self.subxacts += 1 + other.subxacts
+
+    def as_dict(self):
+        return {
+            "xid": self.xid,
+            "lsn_start": format_lsn(self.first_lsn),
+            "lsn_end": format_lsn(self.end_lsn) if self.end_lsn is not None else None,
+            "commit_time": self.end_time,
+            "updates": self.updates,
+            "subxacts": self.subxacts,
+        }
+
+class WalStats(object):
+    """Accumulates the statistics of the records fed to add(). Keeps the
+    top committed transactions by number of heap modifications."""
+    def __init__(self, top=10):
+        self.top = top
+        self.nrecs = 0
+        self.total_bytes = 0
+        self.fpi_bytes = 0
+        self.start_lsn = None
+        self.end_lsn = None
+        # (rmid, info operation) -> [records, record bytes, fpi bytes, init page records]
+        self.rminfos = {}
+        # RelFileNode -> [records, bytes]
+        self.relations = {}
+        self.running = {}
+        self.committed = []
+        self.seq = 0
+        self.aborted = 0
+
+    def add(self, rec):
+        header = rec.header
+        lsn = rec.lsn
+        if self.start_lsn is None:
+            self.start_lsn = lsn
+        self.end_lsn = lsn + header.tot_len
+        self.nrecs += 1
+        self.total_bytes += header.tot_len
+        rmid = header.rmid
+        info = xlogfilter.info_op(rmid, header.info)
+        record_len = RECORD_HEADER_LEN + header.len
+        fpi_len = header.tot_len - record_len
+        self.fpi_bytes += fpi_len
+
+        counts = self.rminfos.get((rmid, info))
+        if counts is None:
+            counts = self.rminfos[(rmid, info)] = [0, 0, 0, 0]
+        counts[0] += 1
+        counts[1] += record_len
+        counts[2] += fpi_len
+        if rmid in HEAP_RMIDS and header.info & XLOG_HEAP_INIT_PAGE:
+            counts[3] += 1
+
+        node = rec.filenode
+        if node is not None:
+            self.add_relation(node, record_len)
+        if fpi_len:
+            for block, contents in rec.blocks:
+                if node is None:
+                    # Attribute the record to the relation of its first block
+                    node = block.node
+                    self.add_relation(node, record_len)
+                self.add_relation(block.node, BKP_BLOCK_HEADER_LEN + len(contents), 0)
+
+        if rmid == RM_HEAP_ID and (header.info & XLOG_HEAP_OPMASK) in HEAP_MOD_INFOS:
+            stats = self.running.get(header.xid)
+            if stats is None:
+                stats = self.running[header.xid] = XactStats(header.xid, lsn)
+            stats.updates += 1
+        elif rmid == RM_XACT_ID and rec.rmdata is not None:
+            self.add_xact(rec, info)
+
+    def add_relation(self, node, nbytes, nrecs=1):
+        counts = self.relations.get(node)
+        if counts is None:
+            counts = self.relations[node] = [0, 0]
+        counts[0] += nrecs
+        counts[1] += nbytes
+
+    def add_xact(self, rec, info):
+        data = rec.rmdata
+        xid = rec.header.xid
+        if info == XLOG_XACT_ASSIGNMENT:
+            if len(data) >= XACT_ASSIGNMENT.size:
+                xtop, nsubxacts = XACT_ASSIGNMENT.unpack_from(data)
+                self.merge(xtop, parse_xids(data, XACT_ASSIGNMENT.size, nsubxacts))
+            return
+        if info in (XLOG_XACT_COMMIT_PREPARED, XLOG_XACT_ABORT_PREPARED):
+            if len(data) < PREPARED_LEN:
+                return
+            xid, = PREPARED_XID.unpack_from(data)
+            data = data[PREPARED_LEN:]
+            info = XLOG_XACT_COMMIT if info == XLOG_XACT_COMMIT_PREPARED else XLOG_XACT_ABORT
+        elif info not in (XLOG_XACT_COMMIT, XLOG_XACT_COMMIT_COMPACT, XLOG_XACT_ABORT):
+            return
+        try:
+            xact_time, subxacts = parse_xact_end(info, data)
+        except struct.error:
+            # Too short for what the info says, still ends the transaction
+            xact_time, subxacts = None, ()
+        stats = self.merge(xid, subxacts)
+        if stats is None:
+            return
+        del self.running[xid]
+        if info == XLOG_XACT_ABORT:
+            self.aborted += 1
+            return
+        stats.end_lsn = rec.lsn
+        if xact_time is not None:
+            stats.end_time = format_timestamp(xact_time)
+        self.seq += 1
+        entry = (stats.updates, self.seq, stats)
+        if len(self.committed) < self.top:
+            heapq.heappush(self.committed, entry)
+        elif entry > self.committed[0]:
+            heapq.heapreplace(self.committed, entry)
+
+    def merge(self, xid, subxacts):
+        """Folds the running stats of subxacts into those of xid."""
+        stats = self.running.get(xid)
+        for subxid in subxacts:
+            other = self.running.pop(subxid, None)
+            if other is None:
+                continue
+            if stats is None:
+                other.xid = xid
+                stats = self.running[xid] = other
+            else:
+                stats.merge(other)
+        return stats
+
+    def as_dict(self):
+        rminfos = []
+        for (rmid, info), (count, record_bytes, fpi_bytes, init_page) in sorted(self.rminfos.items()):
+            rminfo = {
+                "rmgr": RM_NAMES[rmid] if rmid < len(RM_NAMES) else str(rmid),
+                "info": INFOS.get(rmid, {}).get(info, "0x%02X" % info),
+                "count": count,
+                "record_bytes": record_bytes,
+                "fpi_bytes": fpi_bytes,
+            }
+            if rmid in HEAP_RMIDS:
+                rminfo["init_page"] = init_page
+            rminfos.append(rminfo)
+        relations = sorted(self.relations.items(), key=lambda item: item[1][1], reverse=True)
+        running = sorted(self.running.values(), key=lambda s: s.updates, reverse=True)
+        return {
+            "start_lsn": format_lsn(self.start_lsn) if self.start_lsn is not None else None,
+            "end_lsn": format_lsn(self.end_lsn) if self.end_lsn is not None else None,
+            "records": self.nrecs,
+            "bytes": self.total_bytes,
+            "fpi_bytes": self.fpi_bytes,
+            "rmgrs": rminfos,
+            "relations": [{"node": "%d/%d/%d" % node, "records": count, "bytes": nbytes}
+                          for node, (count, nbytes) in relations[:self.top]],
+            "transactions": [stats.as_dict() for n, seq, stats in sorted(self.committed, reverse=True)],
+            "aborted": self.aborted,
+            "running": [stats.as_dict() for stats in running[:self.top]],
+        }
+
+def collect(path, tli, seg, top=10, start_lsn=None, end_lsn=None):
+    stats = WalStats(top)
+    for rec in xlogfilter.records(path, tli, seg, verbose=False,
+                                  start_lsn=start_lsn, end_lsn=end_lsn):
+        stats.add(rec)
+    return stats
+
+from optparse import OptionParser
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] startseg")
+    parser.add_option("-n", "--top", dest="top", type="int", default=10,
+                      help="Number of relations and transactions to list [default: %default]")
+    parser.add_option("--start-lsn", dest="start_lsn",
+                      help="Start at the first record starting at or after LSN (X/X), "
+                           "in the segment holding it instead of startseg")
+    parser.add_option("--end-lsn", dest="end_lsn",
+                      help="Stop at the first record starting at or after LSN (X/X)")
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write the JSON to OUTPUT instead of stdout")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    start_file = args[0]
+    tli, seg = xlogfilter.parse_xlog_filename(os.path.basename(start_file))
+    start_lsn = xlogfilter.parse_lsn(options.start_lsn) if options.start_lsn else None
+    end_lsn = xlogfilter.parse_lsn(options.end_lsn) if options.end_lsn else None
+    stats = collect(os.path.dirname(start_file) or ".", tli, seg, options.top, start_lsn, end_lsn)
+    if options.output:
+        with open(options.output, 'w') as fd:
+            json.dump(stats.as_dict(), fd, indent=1)
+    else:
+        json.dump(stats.as_dict(), sys.stdout, indent=1)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,21 @@
-#!/usr/bin/python
-from prototype import *
+#!/usr/bin/python3
 import crc32
 import sys
 import struct
 from collections import namedtuple
+import bisect
+import bz2
+import fcntl
+import gzip
+import json
+import lzma
+import mmap
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
+import time
 
 XLogPageHeader = namedtuple('XLogPageHeader',
                                 ['magic', 'info', 'tli', 'pageaddr', 'rem_len'])
@@ -20,6 +31,17 @@ BkpBlock = namedtuple("BkpBlock", [
 ])
 
 RECORD_HEADER_LEN = 32
+BKP_BLOCK_HEADER_LEN = 24
+
+# Precompiled layouts of the on-disk structs
+RECORD_STRUCT = struct.Struct("IIIBBLI")
+RELFILENODE_STRUCT = struct.Struct("III")
+BKP_BLOCK_STRUCT = struct.Struct("IIIIIHH")
+LONG_HEADER_STRUCT = struct.Struct("HHILILII")
+SHORT_HEADER_STRUCT = struct.Struct("HHILI")
+
+# Number of backup blocks for the low info bits
+NUM_BLOCKS = tuple(bin(i).count('1') for i in range(16))
 
 RM_NAMES = [
     "XLOG",
@@ -211,65 +233,107 @@ def align8(v):
 
 def parse_relfilenode(data):
     assert len(data)>=12
-    return RelFileNode(*struct.unpack("III", data[0:12]))
+    return RelFileNode._make(RELFILENODE_STRUCT.unpack_from(data))
 
 def parse_record(data):
     assert len(data) >= RECORD_HEADER_LEN
-    return XLogRecord(*struct.unpack("IIIBBLI", data[0:28]))
+    return XLogRecord._make(RECORD_STRUCT.unpack_from(data))
+
+def parse_backup_blocks(blockdata, count):
+    """Returns [(BkpBlock, contents)] for count backup blocks. Contents are
+    views of blockdata, not copies."""
+    blockdata = memoryview(blockdata)
+    blocks = []
+    offset = 0
+    for i in range(count):
+        spc, db, rel, fork, blkno, hole_offset, hole_length = \
+            BKP_BLOCK_STRUCT.unpack_from(blockdata, offset)
+        block = BkpBlock(RelFileNode(spc, db, rel), fork, blkno, hole_offset, hole_length)
+        offset += BKP_BLOCK_HEADER_LEN
+        content_len = 8192 - hole_length
+        blocks.append((block, blockdata[offset:offset+content_len]))
+        offset += content_len
+    return blocks
+
+# Records of these resource managers start with the RelFileNode they touch
+FILENODE_RMIDS = frozenset([RM_SMGR_ID, RM_HEAP_ID, RM_HEAP2_ID, RM_BTREE_ID,
+                            RM_GIN_ID, RM_GIST_ID, RM_SEQ_ID, RM_SPGIST_ID])
+
+# The heap resource managers keep XLOG_HEAP_INIT_PAGE in the high info bit,
+# the operation is in the bits below it
+XLOG_HEAP_OPMASK = 0x70
+HEAP_RMIDS = frozenset([RM_HEAP_ID, RM_HEAP2_ID])
+
+def info_op(rmid, info):
+    """The operation of the record info, without flag bits."""
+    return info & (XLOG_HEAP_OPMASK if rmid in HEAP_RMIDS else 0xF0)
+
+def starts_with_filenode(rmid, info):
+    return rmid in FILENODE_RMIDS or (
+        rmid == RM_XLOG_ID and (info & 0xF0) == I["XLOG_FPI"])
+
+XLOG_SWITCH = I["XLOG_SWITCH"]
 
 class Record(object):
-    def __init__(self, lsn, header, rmdata, blocks):
+    """A decoded WAL record. Backup blocks are only parsed out of blockdata
+    when blocks is first used."""
+    __slots__ = ('lsn', 'header', 'rmdata', 'blockdata', '_blocks')
+
+    def __init__(self, lsn, header, rmdata, blocks=None, blockdata=None):
         self.lsn = lsn
         self.header = header
         self.rmdata = rmdata
-        self.blocks = blocks
+        self.blockdata = blockdata
+        self._blocks = blocks
 
     @classmethod
     def read_from(cls, fd):
         rmdata = None
-        blocks = []
+        blockdata = None
         
         lsn, data = fd.read(RECORD_HEADER_LEN, align=True)
-        header = parse_record(data)
-        #print "rec %08x: %r" % (lsn,header,)
-        if header.tot_len == 0:
+        header = XLogRecord._make(RECORD_STRUCT.unpack_from(data))
+        #print("rec %08x: %r" % (lsn,header,))
+        tot_len = header.tot_len
+        if tot_len == 0:
             raise StopIteration()
         if header.len != 0:
             _, rmdata = fd.read(header.len)
         
-        backupblockslen = header.tot_len - header.len - RECORD_HEADER_LEN
+        backupblockslen = tot_len - header.len - RECORD_HEADER_LEN
         if backupblockslen:
             _, blockdata = fd.read(backupblockslen)
-            offset = 0
-            for i in xrange(bin(header.info & 0x0F).count('1')):
-                node = parse_relfilenode(blockdata[offset:offset+12])
-                block = BkpBlock(node, *struct.unpack("IIHH", blockdata[offset+12:offset+24]))
-                content_len = (8192 - block.hole_length)
-                contents = blockdata[offset+24:offset+24+content_len]
-                offset += 24+content_len
-                blocks.append((block, contents))
         
-        if header.rmid == RM_XLOG_ID and (header.info & 0xF0 == I["XLOG_SWITCH"]):
+        if header.rmid == RM_XLOG_ID and (header.info & 0xF0 == XLOG_SWITCH):
             nlsn = fd.pos
             to_end_of_page = XLOG_BLCKSZ - (nlsn & XLOG_BLCK_MASK)
             next_page = (nlsn & ~XLOG_BLCK_MASK) + XLOG_BLCKSZ
             next_seg = (nlsn & ~XLOG_SIZE_MASK) + XLOG_SIZE
-            num_blocks = (next_seg - next_page) / XLOG_BLCKSZ
+            num_blocks = (next_seg - next_page) // XLOG_BLCKSZ
             data_per_block = XLOG_BLCKSZ - HEADER_LEN
             
-            #print "%08x %08x" % (lsn, nlsn)
-            #print "End of page in %d" % to_end_of_page
-            #print "Next page @ %08X" % next_page
-            #print "Next seg @ %08X" % next_seg
-            #print "Num blocks %d" % num_blocks
-            #print "Total: %d" % (to_end_of_page + num_blocks*data_per_block)
-            fd.read(to_end_of_page + num_blocks*data_per_block)
+            #print("%08x %08x" % (lsn, nlsn))
+            #print("End of page in %d" % to_end_of_page)
+            #print("Next page @ %08X" % next_page)
+            #print("Next seg @ %08X" % next_seg)
+            #print("Num blocks %d" % num_blocks)
+            #print("Total: %d" % (to_end_of_page + num_blocks*data_per_block))
+            fd.skip(to_end_of_page + num_blocks*data_per_block)
 
-        return cls(lsn, header, rmdata, blocks)
+        return cls(lsn, header, rmdata, None, blockdata)
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            if self.blockdata is None:
+                self._blocks = []
+            else:
+                self._blocks = parse_backup_blocks(self.blockdata, self.num_blocks)
+        return self._blocks
 
     @property
     def num_blocks(self):
-        return bin(self.header.info & 0x0F).count('1')
+        return NUM_BLOCKS[self.header.info & 0x0F]
 
     @property
     def rm_name(self):
@@ -279,6 +343,14 @@ class Record(object):
     def rmid(self):
         return self.header.rmid
 
+    @property
+    def filenode(self):
+        """The RelFileNode the record data starts with, if it has one."""
+        if (starts_with_filenode(self.header.rmid, self.header.info) and
+                self.rmdata is not None and len(self.rmdata) >= FILENODE_LEN):
+            return parse_relfilenode(self.rmdata)
+        return None
+
     @property
     def info(self):
         return self.header.info & 0xF0
@@ -295,11 +367,11 @@ class Record(object):
 
 def read_xlog_long_page_header(src):
     data = src.read(40)
-    return XLogLongPageHeader(*struct.unpack("HHILILII", data))
+    return XLogLongPageHeader._make(LONG_HEADER_STRUCT.unpack_from(data))
 
 def read_xlog_page_header(src):
     data = src.read(24)
-    return XLogPageHeader(*struct.unpack("HHILI", data[0:20]))
+    return XLogPageHeader._make(SHORT_HEADER_STRUCT.unpack_from(data))
 
 XLOG_SIZE = 16*1024*1024
 
@@ -309,89 +381,379 @@ XLOG_BLCK_MASK = XLOG_BLCKSZ-1
 LONG_HEADER_LEN = 40
 HEADER_LEN = 24
 
-class xlogfilereader(object):
+ZERO_PAGE = memoryview(bytes(XLOG_BLCKSZ))
+
+# Compressed segments are named like the plain ones plus one of these
+COMPRESSIONS = {
+    ".gz": gzip,
+    ".xz": lzma,
+    ".bz2": bz2,
+}
+
+def compression_of(path):
+    ext = os.path.splitext(path)[1]
+    return ext if ext in COMPRESSIONS else None
+
+class SegmentCatalog(object):
+    """The WAL segments of an archive directory, listed with one scandir.
+
+    Timeline history files are followed, so a timeline's segments from
+    before it branched off come from its parent. Plain segments are
+    preferred over compressed ones."""
     def __init__(self, path):
         self.path = path
-        self.tli = 1
-        self.seg = 1
-        self.files = self.xlog_files()
-        self.cur_file = open(next(self.files))
-        self.remaining = XLOG_SIZE
+        self.scan()
+
+    def scan(self):
+        self.files = {}
+        self.history_files = {}
+        self.histories = {}
+        self.mtime = os.stat(self.path).st_mtime_ns
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                name = entry.name
+                try:
+                    if name.endswith(".history") and len(name) == 16:
+                        self.history_files[int(name[:8], 16)] = entry.path
+                        continue
+                    if len(name) < 24 or (name[24:] and name[24:] not in COMPRESSIONS):
+                        continue
+                    int(name[:24], 16)
+                except ValueError:
+                    continue
+                key = parse_xlog_filename(name)
+                if name[24:] and key in self.files:
+                    continue
+                self.files[key] = entry.path
+
+    def changed(self):
+        return os.stat(self.path).st_mtime_ns != self.mtime
+
+    def history(self, tli):
+        """[(tli, begin lsn)] of tli and the timelines it descends from,
+        newest first."""
+        if tli not in self.histories:
+            begins = []
+            begin = 0
+            if tli in self.history_files:
+                with open(self.history_files[tli]) as fd:
+                    for line in fd:
+                        fields = line.split()
+                        if not fields or fields[0].startswith("#"):
+                            continue
+                        begins.append((int(fields[0]), begin))
+                        begin = parse_lsn(fields[1])
+            begins.append((tli, begin))
+            self.histories[tli] = begins[::-1]
+        return self.histories[tli]
+
+    def timelines(self):
+        return sorted(set(tli for tli, seg in self.files))
+
+    def segment_path(self, tli, seg):
+        for seg_tli, begin in self.history(tli):
+            if begin // XLOG_SIZE <= seg:
+                return self.files.get((seg_tli, seg))
+        return None
+
+    def segments(self, tli):
+        """Sorted segment numbers available on tli."""
+        ancestors = set(seg_tli for seg_tli, begin in self.history(tli))
+        return sorted(seg for seg in set(seg for seg_tli, seg in self.files if seg_tli in ancestors)
+                      if self.segment_path(tli, seg) is not None)
+
+    def gaps(self, tli):
+        """[(first missing, next present)] segment ranges missing on tli."""
+        segs = self.segments(tli)
+        return [(a + 1, b) for a, b in zip(segs, segs[1:]) if b != a + 1]
+
+    def lsn_range(self, tli, start_lsn=None, end_lsn=None):
+        """(first, last) segment numbers of the WAL from start_lsn, the first
+        segment on tli by default, up to end_lsn. last is None without
+        end_lsn, reading then goes on to the end of WAL or a gap."""
+        if start_lsn is not None:
+            seg = start_lsn // XLOG_SIZE
+        else:
+            seg = (self.segments(tli) or [1])[0]
+        return seg, None if end_lsn is None else max(seg, (end_lsn - 1) // XLOG_SIZE)
+
+_catalogs = {}
+
+def segment_catalog(path):
+    """The SegmentCatalog of path, scanned once per process."""
+    path = os.path.abspath(path)
+    if path not in _catalogs:
+        _catalogs[path] = SegmentCatalog(path)
+    return _catalogs[path]
+
+def segment_file(path, tli, seg):
+    """Returns the file holding segment seg, plain or compressed, or None.
+    Rescans the directory if it changed since it was listed."""
+    catalog = segment_catalog(path)
+    found = catalog.segment_path(tli, seg)
+    if found is None and catalog.changed():
+        catalog.scan()
+        found = catalog.segment_path(tli, seg)
+    return found
+
+def readahead(path):
+    """Asks the kernel to start reading path in the background."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def segment_files(path, tli, seg, end_seg=None, ahead=4, verbose=True):
+    """Yields the paths of consecutive segments from seg until a gap or
+    end_seg, with readahead hints for the next ahead ones."""
+    advised = seg
+    while end_seg is None or seg <= end_seg:
+        xlogfile = segment_file(path, tli, seg)
+        if xlogfile is None:
+            if verbose:
+                missing = "%s/%08X%08X%08X" % (path, tli, seg>>8, seg&0xFF)
+                later = [present for first, present in segment_catalog(path).gaps(tli)
+                         if first <= seg < present]
+                if later:
+                    print(missing, "does not exist, WAL continues at %s" % format_lsn(later[0]*XLOG_SIZE))
+                else:
+                    print(missing, "does not exist")
+            return
+        while advised < seg + ahead and (end_seg is None or advised < end_seg):
+            advised += 1
+            ahead_file = segment_file(path, tli, advised)
+            if ahead_file is None:
+                break
+            readahead(ahead_file)
+        yield xlogfile
+        seg += 1
+
+def map_segment(path):
+    """Returns a read-only memoryview of a whole segment file. The mapping
+    goes away once the last slice taken from it is released. Compressed
+    segments are decompressed into memory instead."""
+    compression = compression_of(path)
+    if compression is not None:
+        with COMPRESSIONS[compression].open(path, 'rb') as fd:
+            return memoryview(fd.read())
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+class xlogfilereader(object):
+    """Reads consecutive segments through mmap. read() returns memoryview
+    slices of the mapping, only a read crossing into the next segment is
+    copied. With end_lsn, reading stops after the segment following the
+    one holding it, where a record starting before it can end."""
+    def __init__(self, path, tli=None, seg=None, verbose=True, end_lsn=None):
+        catalog = segment_catalog(path)
+        if tli is None:
+            tli = max(catalog.timelines() or [1])
+        seg, end_seg = catalog.lsn_range(tli, None if seg is None else seg*XLOG_SIZE, end_lsn)
+        if end_seg is not None:
+            end_seg += 1
+        self.path = path
+        self.tli = tli
+        self.seg = seg
+        self.verbose = verbose
+        self.files = segment_files(path, tli, seg, end_seg, verbose=verbose)
+        self.view = None
+        self.offset = 0
+        self.map_next()
         self.start_lsn = XLOG_SIZE*self.seg
-        
-    def xlog_files(self):
-        seg = self.seg
-        while True:
-            path = "%s/%08X%08X%08X" % (self.path, self.tli, seg>>8, seg&0xFF) 
-            if not os.path.exists(path):
-                print path, "does not exist"
-                return
-            yield path
-            seg += 1
+
+    def map_next(self):
+        path = next(self.files, None)
+        if path is None:
+            raise EOFError("no more WAL segments")
+        self.view = map_segment(path)
+        self.offset = 0
 
     def read(self, amount):
         assert amount > 0
-        if amount < self.remaining:
-            self.remaining -= amount
-            return self.cur_file.read(amount)
-        buf = self.cur_file.read(self.remaining)
-        amount -= self.remaining
-        self.cur_file.close()
-        self.cur_file = open(next(self.files))
-        self.remaining = XLOG_SIZE
-        self.remaining -= amount
-        return buf + self.cur_file.read(amount)
+        if self.offset == len(self.view):
+            self.map_next()
+        end = self.offset + amount
+        if end <= len(self.view):
+            data = self.view[self.offset:end]
+            self.offset = end
+            return data
+        parts = []
+        while amount:
+            if self.offset == len(self.view):
+                self.map_next()
+            end = min(self.offset + amount, len(self.view))
+            parts.append(self.view[self.offset:end])
+            amount -= end - self.offset
+            self.offset = end
+        return b"".join(parts)
 
 class xlogreader(object):
     def __init__(self, filereader):
         self.fd = filereader
         self.pos = filereader.start_lsn
         
-    def read(self, amount, align=False):
-        def read_header():
-            if self.pos % XLOG_SIZE == 0:
-                #print
-                #print "    ",
-                header = read_xlog_long_page_header(self.fd)
-                print header
-                self.pos += 40
-            elif self.pos % 8192 == 0:        
-                #print
-                #print "    ",
-                header = read_xlog_page_header(self.fd)
-                self.pos += 24
-        
-        #print "Reading %d at %04x" % (amount, self.pos)
-
-
+    def read_header(self):
+        if self.pos % XLOG_SIZE == 0:
+            header = read_xlog_long_page_header(self.fd)
+            #print(header)
+            self.pos += LONG_HEADER_LEN
+        elif self.pos % XLOG_BLCKSZ == 0:
+            header = read_xlog_page_header(self.fd)
+            self.pos += HEADER_LEN
+
+    def read_pieces(self, amount, align=False):
+        """Yields (lsn, data) for each page-contiguous piece of the next
+        amount bytes, skipping page headers in between."""
         if align and self.pos & 7:
             newpos = align8(self.pos)
             self.fd.read(newpos - self.pos)
-            #print "  aligned to %04x by %d" % (newpos, newpos - self.pos)
+            #print("  aligned to %04x by %d" % (newpos, newpos - self.pos))
             self.pos = newpos
-        
-        read_header()
 
-        buf = ""
-        lsn = self.pos
-        amount_todo = amount
-        free = (8192 - (self.pos % 8192))
-        
-        while amount_todo > free:
-            buf += self.fd.read(free)
+        self.read_header()
+
+        free = XLOG_BLCKSZ - (self.pos % XLOG_BLCKSZ)
+        while amount > free:
+            lsn = self.pos
             self.pos += free
-            read_header()
-            amount_todo -= free
-            free = 8192-24
-        buf += self.fd.read(amount_todo)
-        self.pos += amount_todo
-                
-        return lsn, buf
-
-def records(path):
-    reader = xlogreader(xlogfilereader(path))
+            yield lsn, self.fd.read(free)
+            self.read_header()
+            amount -= free
+            free = XLOG_BLCKSZ - (self.pos % XLOG_BLCKSZ)
+        lsn = self.pos
+        self.pos += amount
+        yield lsn, self.fd.read(amount)
+
+    def read(self, amount, align=False, crc=None):
+        """Reads amount bytes of record data. If crc is given, the pieces are
+        fed to it as they are read. Data within one page is returned as a
+        memoryview of the segment, only data spanning pages is copied."""
+        #print("Reading %d at %04x" % (amount, self.pos))
+        pos = self.pos
+        if align and pos & 7:
+            pos = align8(pos)
+        offset = pos & XLOG_BLCK_MASK
+        if offset and amount <= XLOG_BLCKSZ - offset:
+            # Common case, no page header in the way
+            if pos != self.pos:
+                self.fd.read(pos - self.pos)
+            data = self.fd.read(amount)
+            self.pos = pos + amount
+            if crc is not None:
+                crc.update(data)
+            return pos, data
+        pieces = []
+        for piece_lsn, piece in self.read_pieces(amount, align):
+            if not pieces:
+                lsn = piece_lsn
+            if crc is not None:
+                crc.update(piece)
+            pieces.append(piece)
+        if len(pieces) == 1:
+            return lsn, pieces[0]
+        return lsn, b"".join(pieces)
+
+    def skip(self, amount):
+        for piece_lsn, piece in self.read_pieces(amount):
+            pass
+
+    def skip_contrecord(self):
+        """At the start of a segment, skips over the tail of a record
+        continued from the previous segment."""
+        assert self.pos % XLOG_SIZE == 0
+        header = read_xlog_long_page_header(self.fd)
+        self.pos += LONG_HEADER_LEN
+        if header.rem_len:
+            self.skip(header.rem_len)
+
+# Record header layout per WAL format, as far as CRC checking needs it.
+# Pre-9.5 WAL uses the legacy CRC and a 32 byte header, 9.5 and later use
+# CRC-32C and a 24 byte header. Both compute the CRC over the record body
+# first and then over the header up to the crc field.
+RecordFormat = namedtuple("RecordFormat", [
+    'crc', 'header_len', 'crc_offset', 'info_offset', 'rmid_offset'
+])
+RECORD_FORMATS = {
+    "legacy": RecordFormat(crc32.LEGACY, 32, 24, 12, 13),
+    "crc32c": RecordFormat(crc32.CRC32C, 24, 20, 16, 17),
+}
+
+def format_lsn(lsn):
+    return "%X/%08X" % (lsn >> 32, lsn & 0xFFFFFFFF)
+
+def parse_lsn(text):
+    hi, lo = text.split("/")
+    return (int(hi, 16) << 32) + int(lo, 16)
+
+def verify_records(reader, fmt):
+    """Checks the CRC of every record until the end of WAL.
+
+    Returns (number of good records, lsn of the first bad record or None).
+    A record cut short by the end of the segments counts as bad."""
+    nrecs = 0
+    while True:
+        lsn = align8(reader.pos)
+        try:
+            lsn, header = reader.read(fmt.header_len, align=True)
+            tot_len, = struct.unpack_from("I", header, 0)
+            if tot_len == 0:
+                return nrecs, None
+            if tot_len < fmt.header_len:
+                return nrecs, lsn
+            crc = crc32.PGCRC32(backend=fmt.crc)
+            if tot_len > fmt.header_len:
+                for piece_lsn, piece in reader.read_pieces(tot_len - fmt.header_len):
+                    crc.update(piece)
+        except EOFError:
+            # Ran out of segments. Only the end of WAL at a segment boundary,
+            # otherwise a record or the last segment was cut short
+            if lsn & XLOG_SIZE_MASK == 0 and reader.pos == lsn:
+                return nrecs, None
+            return nrecs, lsn
+        crc.update(header[0:fmt.crc_offset])
+        expected, = struct.unpack_from("I", header, fmt.crc_offset)
+        if crc.digest() != expected:
+            return nrecs, lsn
+        nrecs += 1
+
+        rmid = header[fmt.rmid_offset]
+        info = header[fmt.info_offset]
+        if rmid == RM_XLOG_ID and (info & 0xF0) == I["XLOG_SWITCH"]:
+            to_next_seg = XLOG_SIZE - (reader.pos & XLOG_SIZE_MASK)
+            if to_next_seg < XLOG_SIZE:
+                reader.fd.read(to_next_seg)
+                reader.pos += to_next_seg
+
+def records(path, tli=None, seg=None, verbose=True, start_lsn=None, end_lsn=None):
+    """The records from segment seg, or from the first one starting at or
+    after start_lsn, up to the last one starting before end_lsn."""
+    if start_lsn is not None:
+        seg = start_lsn // XLOG_SIZE
+    reader = xlogreader(xlogfilereader(path, tli, seg, verbose, end_lsn))
+    reader.skip_contrecord()
     while True:
-        yield Record.read_from(reader)
+        try:
+            rec = Record.read_from(reader)
+        except (StopIteration, EOFError):
+            return
+        if end_lsn is not None and rec.lsn >= end_lsn:
+            return
+        if start_lsn is None or rec.lsn >= start_lsn:
+            yield rec
+
+def record_at(path, tli, lsn):
+    """Reads the single record starting at lsn."""
+    reader = xlogreader(xlogfilereader(path, tli, lsn // XLOG_SIZE))
+    reader.fd.offset = lsn & XLOG_SIZE_MASK
+    reader.pos = lsn
+    return Record.read_from(reader)
 
 def show_node(node):
     return "N(%s, %s, %s)" % node
@@ -450,41 +812,375 @@ def write_noop_rec(buf, rec):
     crc = crc32.pgcrc32_arr(buf[0:24], init_zeroes=rec.tot_len - RECORD_HEADER_LEN)
     struct.pack_into("I", buf, 24, crc)
 
-def filter_machine(start_lsn, src, dest, exclude_filenodes):
+# Verdicts of RecordFilter
+PASS = 0
+FILTER = 1
+NEED_NODE = 2
+
+def _merge_ranges(ranges):
+    """Sorts and merges inclusive (start, end) ranges into parallel lists of
+    starts and ends for bisecting."""
+    starts, ends = [], []
+    for start, end in sorted(ranges):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+def _in_ranges(starts, ends, value):
+    i = bisect.bisect_right(starts, value) - 1
+    return i >= 0 and value <= ends[i]
+
+class RecordFilter(object):
+    """Decides which records filter_machine turns into XLOG_NOOP.
+
+    A record is filtered if any rule matches: its RelFileNode, database or
+    tablespace (for records starting with one), its rmid or rmid and info,
+    its xid or its start lsn. Ranges are inclusive. The rules are compiled
+    into dispatch, indexed by rmid, holding a single function per resource
+    manager that only looks at what can matter for it, or None if nothing
+    can. The cost per record does not grow with the number of rules."""
+    def __init__(self, filenodes=(), databases=(), tablespaces=(), rmids=(),
+                 rminfos=(), xids=(), xid_ranges=(), lsn_ranges=()):
+        self.filenodes = frozenset(filenodes)
+        self.databases = frozenset(databases)
+        self.tablespaces = frozenset(tablespaces)
+        self.rmids = frozenset(rmids)
+        self.rminfos = frozenset(rminfos)
+        self.xids = frozenset(xids)
+        self.xid_ranges = list(xid_ranges)
+        self.lsn_ranges = list(lsn_ranges)
+        self.compile()
+
+    def __getstate__(self):
+        # Compiled closures don't pickle, pool workers compile their own
+        state = self.__dict__.copy()
+        del state['dispatch']
+        del state['node_check']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def compile(self):
+        header_checks = []
+        if self.xids:
+            xids = self.xids
+            header_checks.append(lambda rec, lsn: rec.xid in xids)
+        if self.xid_ranges:
+            xid_starts, xid_ends = _merge_ranges(self.xid_ranges)
+            header_checks.append(lambda rec, lsn: _in_ranges(xid_starts, xid_ends, rec.xid))
+        if self.lsn_ranges:
+            lsn_starts, lsn_ends = _merge_ranges(self.lsn_ranges)
+            header_checks.append(lambda rec, lsn: _in_ranges(lsn_starts, lsn_ends, lsn))
+
+        node_checks = []
+        if self.filenodes:
+            filenodes = self.filenodes
+            node_checks.append(lambda node: node in filenodes)
+        if self.databases:
+            databases = self.databases
+            node_checks.append(lambda node: node.dbNode in databases)
+        if self.tablespaces:
+            tablespaces = self.tablespaces
+            node_checks.append(lambda node: node.spcNode in tablespaces)
+        self.node_check = self._combine(node_checks)
+
+        self.dispatch = [self._compile_rmid(rmid, list(header_checks), bool(node_checks))
+                         for rmid in range(256)]
+
+    @staticmethod
+    def _combine(checks):
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        return lambda *args: any(check(*args) for check in checks)
+
+    def _compile_rmid(self, rmid, header_checks, node_rules):
+        if rmid in self.rmids:
+            return lambda rec, lsn: FILTER
+        infos = frozenset(info for rm, info in self.rminfos if rm == rmid)
+        if infos:
+            mask = XLOG_HEAP_OPMASK if rmid in HEAP_RMIDS else 0xF0
+            header_checks.append(lambda rec, lsn: (rec.info & mask) in infos)
+        header_check = self._combine(header_checks)
+
+        if node_rules and rmid in FILENODE_RMIDS:
+            needs_node = lambda rec: True
+        elif node_rules and rmid == RM_XLOG_ID:
+            needs_node = lambda rec: starts_with_filenode(rec.rmid, rec.info)
+        else:
+            needs_node = None
+
+        if header_check is None and needs_node is None:
+            return None
+        if needs_node is None:
+            return lambda rec, lsn: FILTER if header_check(rec, lsn) else PASS
+        if header_check is None:
+            return lambda rec, lsn: NEED_NODE if needs_node(rec) else PASS
+        def decide(rec, lsn):
+            if header_check(rec, lsn):
+                return FILTER
+            return NEED_NODE if needs_node(rec) else PASS
+        return decide
+
+    def decide(self, rec, lsn):
+        """PASS, FILTER or NEED_NODE, in which case node_check has the
+        final word."""
+        decide = self.dispatch[rec.rmid]
+        if decide is None:
+            return PASS
+        return decide(rec, lsn)
+
+# What filter_machine needs to pick up at a segment boundary: the state,
+# the pending amount and whatever it has buffered of the current record
+FilterState = namedtuple("FilterState", [
+    'state', 'substate', 'amount', 'rem_len', 'buf', 'buf_lsn', 'buf_headers'
+])
+
+class FilterStats(object):
+    """Counters and timers of filter_machine runs.
+
+    Records seen per rmid, records filtered and bytes copied, zeroed and
+    buffered are counted by filter_machine itself. Time spent reading and
+    writing is taken by wrapping src and dest with source() and writer(),
+    whatever else is parsing. With progress set, a progress line is printed
+    at the first segment boundary after every progress seconds. finish()
+    ends the run."""
+    def __init__(self, start_lsn=0, progress=None):
+        self.start_lsn = start_lsn
+        self.lsn = start_lsn
+        self.progress = progress
+        self.records = [0] * 256
+        self.filtered = 0
+        self.copied = 0
+        self.zeroed = 0
+        self.buffered = 0
+        self.segments = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+        # Of merged filter_segment runs, which overlap in time
+        self.workers = 0
+        self.worker_parse_time = 0.0
+        self.start = time.time()
+        self.end = None
+        self.last_progress = self.start
+        self.current = 0
+
+    def merge(self, other):
+        """Adds the counters of a finished filter_segment run. Its segments
+        are not, it reads on into the next segment for the spill."""
+        for rmid, count in enumerate(other.records):
+            self.records[rmid] += count
+        self.filtered += other.filtered
+        self.copied += other.copied
+        self.zeroed += other.zeroed
+        self.buffered += other.buffered
+        self.segments += 1
+        self.read_time += other.read_time
+        self.write_time += other.write_time
+        self.workers += 1
+        self.worker_parse_time += other.parse_time
+        self.lsn = max(self.lsn, other.start_lsn + XLOG_SIZE)
+        self.tick()
+
+    def source(self, src):
+        for data in TimedIterator(src, self):
+            self.current = len(data)
+            yield data
+            # filter_machine only asks for the next segment once done with this one
+            self.segment_done()
+
+    def segment_done(self):
+        if self.current:
+            self.lsn += self.current
+            self.segments += 1
+            self.current = 0
+            self.tick()
+
+    def finish(self):
+        """Counts the segment filter_machine stopped in and stops the clock."""
+        self.segment_done()
+        self.end = time.time()
+
+    def writer(self, dest):
+        return TimedWriter(dest, self)
+
+    def tick(self):
+        if self.progress is None:
+            return
+        now = time.time()
+        if now - self.last_progress >= self.progress:
+            self.last_progress = now
+            print(self.progress_line())
+
+    @property
+    def elapsed(self):
+        return max((self.end or time.time()) - self.start, 1e-6)
+
+    @property
+    def parse_time(self):
+        """Time neither reading nor writing. Wall-clock time can't tell that
+        for overlapping filter_segment runs, they measure their own."""
+        if self.workers:
+            return self.worker_parse_time
+        return max(self.elapsed - self.read_time - self.write_time, 0.0)
+
+    def progress_line(self):
+        elapsed = self.elapsed
+        return "At %s: %d segments, %d records, %d filtered, %.1f segments/s, %.1f MB/s" % (
+            format_lsn(self.lsn), self.segments, sum(self.records), self.filtered,
+            self.segments/elapsed, (self.lsn - self.start_lsn)/1e6/elapsed)
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        return {
+            "start_lsn": format_lsn(self.start_lsn),
+            "end_lsn": format_lsn(self.lsn),
+            "segments": self.segments,
+            "elapsed": round(elapsed, 3),
+            "segments_per_sec": round(self.segments/elapsed, 2),
+            "records": sum(self.records),
+            "records_per_rmgr": dict((RM_NAMES[rmid] if rmid < len(RM_NAMES) else str(rmid), count)
+                                     for rmid, count in enumerate(self.records) if count),
+            "filtered": self.filtered,
+            "bytes": {
+                "copied": self.copied,
+                "zeroed": self.zeroed,
+                "buffered": self.buffered,
+            },
+            # Summed over processes with --jobs, so can exceed elapsed
+            "time": {
+                "read": round(self.read_time, 3),
+                "write": round(self.write_time, 3),
+                "parse": round(self.parse_time, 3),
+            },
+        }
+
+class TimedIterator(object):
+    """Iterates src, adding the time taken by each step to stats.read_time."""
+    def __init__(self, src, stats):
+        self.src = iter(src)
+        self.stats = stats
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.src)
+        finally:
+            self.stats.read_time += time.perf_counter() - start
+
+class TimedWriter(object):
+    """Passes writes to dest, adding the time taken to stats.write_time."""
+    def __init__(self, dest, stats):
+        self.dest = dest
+        self.stats = stats
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.dest.write(data)
+        self.stats.write_time += time.perf_counter() - start
+
+    def writev(self, buffers):
+        start = time.perf_counter()
+        self.dest.writev(buffers)
+        self.stats.write_time += time.perf_counter() - start
+
+    def close(self):
+        start = time.perf_counter()
+        self.dest.close()
+        self.stats.write_time += time.perf_counter() - start
+
+def filter_machine(start_lsn, src, dest, rec_filter, end_lsn=None,
+                   skip_contrecord=False, checkpoint=None, resume=None, stats=None):
+    """Copies WAL from src to dest, turning the records rec_filter picks
+    into XLOG_NOOP.
+
+    With skip_contrecord the continuation record at the start of the first
+    segment is copied as is, with end_lsn filtering stops at the first
+    record starting at or after it. Returns True if end of WAL was
+    reached.
+
+    checkpoint is called with the lsn and FilterState at the end of every
+    segment read. A run started with one of those as resume continues
+    where it left off, with output starting at that lsn.
+
+    stats is a FilterStats to count into, without it nothing is counted."""
+    if stats is not None:
+        src = stats.source(src)
+        dest = stats.writer(dest)
+    dispatch = rec_filter.dispatch
+    node_check = rec_filter.node_check
     state, substate = "copy", "normal"
+    if skip_contrecord:
+        substate = "contrecord"
     amount = 0
     buf = bytearray(16*8192)
     buf_offset = 0
     buf_lsn = 0
     buf_headers = []
     rem_len = 0
+    # Buffered output from before start_lsn that was already written
+    skip_out = 0
+    if resume is not None:
+        state, substate, amount, rem_len = resume.state, resume.substate, resume.amount, resume.rem_len
+        buf_offset = len(resume.buf)
+        buf[0:buf_offset] = resume.buf
+        buf_lsn = resume.buf_lsn
+        buf_headers = list(resume.buf_headers)
+        if state == "buffer":
+            skip_out = start_lsn - buf_lsn
+        if substate == "filenode":
+            rec = parse_record(buf[0:RECORD_HEADER_LEN])
     
     
     def write_out_buf():
+        nonlocal skip_out
         offset = 0
         cur_lsn = buf_lsn
+        pieces = []
         for head_lsn, header in buf_headers:
             amount = head_lsn - cur_lsn
             assert offset+amount <= buf_offset
-            dest.write(buf[offset:offset+amount])
-            dest.write(header)
-            #print "- From buffer %d B data %d B header" % (amount, len(header))
+            pieces.append(buf[offset:offset+amount])
+            pieces.append(header)
+            #print("- From buffer %d B data %d B header" % (amount, len(header)))
             offset += amount
             cur_lsn = head_lsn + len(header)
-        dest.write(buf[offset:buf_offset])
-        #print "- From buffer %d B data" % (buf_offset - offset)
+        pieces.append(buf[offset:buf_offset])
+        #print("- From buffer %d B data" % (buf_offset - offset))
+        if skip_out:
+            pieces = [b"".join(pieces)[skip_out:]]
+            skip_out = 0
+        dest.writev(pieces)
 
     lsn = start_lsn
     for data in src:
         for cur_lsn, chunktype, chunk in iterate_chunks(lsn, data):
-            #print "Got chunk at %10X, type %s, length %d" % (cur_lsn, chunktype, len(chunk))
+            #print("Got chunk at %10X, type %s, length %d" % (cur_lsn, chunktype, len(chunk)))
             offset = 0
             chunklen = len(chunk)
             while offset < chunklen:
                 if chunktype is CHUNK_HEADER:
                     if state == "copy":
-                        #print "- Copy header %d bytes" % chunklen
+                        #print("- Copy header %d bytes" % chunklen)
                         dest.write(chunk)
+                        if stats is not None:
+                            stats.copied += chunklen
+                        if substate == "contrecord" and chunklen == LONG_HEADER_LEN:
+                            header = XLogLongPageHeader(*struct.unpack("HHILILII", chunk))
+                            if header.rem_len:
+                                substate = "normal"
+                                amount = header.rem_len
+                            else:
+                                substate = "switch"
                         if substate == "switch" and chunklen == LONG_HEADER_LEN:
                             state, substate = "buffer", "record"
                             amount = RECORD_HEADER_LEN
@@ -492,9 +1188,13 @@ def filter_machine(start_lsn, src, dest, exclude_filenodes):
                             buf_offset = 0
                             buf_lsn = cur_lsn + LONG_HEADER_LEN
                             del buf_headers[:]
+                            if end_lsn is not None and buf_lsn >= end_lsn:
+                                return False
                     elif state == "buffer":
-                        #print "- Buffer header at %10X, %d bytes" % (cur_lsn+offset, chunklen)
+                        #print("- Buffer header at %10X, %d bytes" % (cur_lsn+offset, chunklen))
                         buf_headers.append((cur_lsn+offset, chunk))
+                        if stats is not None:
+                            stats.buffered += chunklen
                     offset += chunklen
                 elif chunktype is CHUNK_DATA:
                     if offset + amount > chunklen:
@@ -503,78 +1203,113 @@ def filter_machine(start_lsn, src, dest, exclude_filenodes):
                     else:
                         subchunk = chunk[offset:offset+amount]
                         inc = amount
-                    #print "- Got %d/%d bytes of data" % (inc, amount)
+                    #print("- Got %d/%d bytes of data" % (inc, amount))
                     amount -= inc
                     offset += inc
 
                     if state == "copy":
                         if substate == "normal" or substate == "switch":
-                            #print "- Copy %d bytes of data" % len(subchunk)
+                            #print("- Copy %d bytes of data" % len(subchunk))
                             dest.write(subchunk)
+                            if stats is not None:
+                                stats.copied += inc
                         elif substate == "zero":
-                            #print "- Zero %d bytes of data" % len(subchunk)
-                            dest.write("\x00"*len(subchunk))
+                            #print("- Zero %d bytes of data" % len(subchunk))
+                            dest.write(ZERO_PAGE[:len(subchunk)])
+                            if stats is not None:
+                                stats.zeroed += inc
                             
                         if not amount and substate != "switch":
                             to_align = maxalign(cur_lsn+offset) - cur_lsn - offset
                             if to_align:
-                                #print "- Need to align by %d bytes" % to_align
+                                #print("- Need to align by %d bytes" % to_align)
                                 amount = to_align
                             else:
-                                #print "- Switch state to read record"
+                                #print("- Switch state to read record")
                                 state, substate = "buffer", "record"
                                 amount = RECORD_HEADER_LEN
                                 # Reset buffering state
                                 buf_offset = 0
                                 buf_lsn = cur_lsn + offset
                                 del buf_headers[:]
+                                if end_lsn is not None and buf_lsn >= end_lsn:
+                                    return False
                     elif state == "buffer":
                         buf[buf_offset:buf_offset+inc] = subchunk
                         buf_offset += inc
-                        #print "- Buffered %d bytes of data" % len(subchunk)
+                        #print("- Buffered %d bytes of data" % len(subchunk))
+                        if stats is not None:
+                            stats.buffered += inc
                         if not amount:
                             if substate == "record":
-                                #print "                              - Got record at %08X" % buf_lsn
+                                #print("                              - Got record at %08X" % buf_lsn)
                                 rec = parse_record(buf[0:RECORD_HEADER_LEN])
                                 rem_len = rec.tot_len - RECORD_HEADER_LEN
                                 
+                                if stats is not None and rec.tot_len:
+                                    stats.records[rec.rmid] += 1
                                 if rec.tot_len == 0:
-                                    print "End of WAL"
-                                    return
+                                    print("End of WAL")
+                                    return True
                                 elif rec.rmid == RM_XLOG_ID and (rec.info & 0xF0) == I["XLOG_SWITCH"]:
-                                    #print "Xlog_switch at %08X" % buf_lsn
+                                    #print("Xlog_switch at %08X" % buf_lsn)
                                     write_out_buf()
                                     state, substate = "copy", "switch"
                                     amount = XLOG_SIZE
-                                #if rec.rmid == RM_XLOG_ID and rec.info == I["XLOG_FPI"]:
-                                elif rec.rmid in [RM_SMGR_ID, RM_HEAP_ID, RM_HEAP2_ID, RM_BTREE_ID,
-                                                RM_GIN_ID, RM_GIST_ID, RM_SEQ_ID, RM_SPGIST_ID] or (
-                                     rec.rmid == RM_XLOG_ID and (rec.info & 0xF0) == I["XLOG_FPI"]
-                                    ):
-                                    #print "- Switch state to filenode"
-                                    amount = FILENODE_LEN
-                                    rem_len -= FILENODE_LEN
-                                    substate = "filenode"
                                 else:
-                                    #print "- Copy out rest %d/%d bytes of the record" % (rem_len, rem_len + RECORD_HEADER_LEN)
-                                    write_out_buf()
-                                    state, substate = "copy", "normal"
-                                    amount = rem_len
+                                    decide = dispatch[rec.rmid]
+                                    if decide is None:
+                                        verdict = PASS
+                                    else:
+                                        # buf_lsn can be the page boundary before the header
+                                        rec_lsn = buf_lsn
+                                        if buf_headers and buf_headers[0][0] == buf_lsn:
+                                            rec_lsn += len(buf_headers[0][1])
+                                        verdict = decide(rec, rec_lsn)
+                                    if verdict == NEED_NODE:
+                                        #print("- Switch state to filenode")
+                                        amount = FILENODE_LEN
+                                        rem_len -= FILENODE_LEN
+                                        substate = "filenode"
+                                    elif verdict == FILTER:
+                                        print("        - Filter record %s at %08X" % (RM_NAMES[rec.rmid], buf_lsn))
+                                        if stats is not None:
+                                            stats.filtered += 1
+                                        write_noop_rec(buf, rec)
+                                        write_out_buf()
+                                        state, substate = "copy", "zero"
+                                        amount = rem_len
+                                    else:
+                                        #print("- Copy out rest %d/%d bytes of the record" % (rem_len, rem_len + RECORD_HEADER_LEN))
+                                        write_out_buf()
+                                        state, substate = "copy", "normal"
+                                        amount = rem_len
                             elif substate == "filenode":
                                 node = parse_relfilenode(buf[RECORD_HEADER_LEN:RECORD_HEADER_LEN+FILENODE_LEN])
-                                if node in exclude_filenodes:
-                                    print "        - Filter record %s at %08X" % (node, buf_lsn)
+                                if node_check(node):
+                                    print("        - Filter record %s at %08X" % (node, buf_lsn))
+                                    if stats is not None:
+                                        stats.filtered += 1
                                     write_noop_rec(buf, rec)                                    
                                     write_out_buf()
                                     state, substate = "copy", "zero"
                                     amount = rem_len
                                 else:
-                                    #print "- Passthrough record"
+                                    #print("- Passthrough record")
                                     write_out_buf()
                                     state, substate = "copy", "normal"
                                     amount = rem_len
                                 
         lsn += len(data)
+        if checkpoint is not None:
+            if state == "buffer":
+                checkpoint(lsn, FilterState(state, substate, amount, rem_len,
+                                            bytes(buf[0:buf_offset]), buf_lsn,
+                                            [(head_lsn, bytes(header))
+                                             for head_lsn, header in buf_headers]))
+            else:
+                checkpoint(lsn, FilterState(state, substate, amount, rem_len, b"", 0, []))
+    return False
 
 class WalWriter(object):
     def __init__(self, path, tli, start_lsn):
@@ -582,20 +1317,25 @@ class WalWriter(object):
         self.tli = tli
         self.start_lsn = start_lsn
         self.lsn = start_lsn
-        #print "Start_lsn", start_lsn
+        #print("Start_lsn", start_lsn)
         self.seg = start_lsn >> 24
         offset = start_lsn&0xFFFFFF
         path = self.output_path
         self.output = None
+        # Called with the end lsn of every completed output segment
+        self.segment_done = None
     
     @property
     def output_path(self):
-        #print "output to %s/%08X%08X%08X" % (self.path, self.tli, self.seg>>8, self.seg&0xFF)
+        #print("output to %s/%08X%08X%08X" % (self.path, self.tli, self.seg>>8, self.seg&0xFF))
         return "%s/%08X%08X%08X" % (self.path, self.tli, self.seg>>8, self.seg&0xFF)
     
+    def open_output(self):
+        self.output = open(self.output_path, 'wb')
+
     def write(self, data):
         if self.output is None:
-            self.output = open(self.output_path, 'w')
+            self.open_output()
 
         self.output.write(data)
         self.lsn += len(data)
@@ -603,79 +1343,974 @@ class WalWriter(object):
             self.output.close()
             self.output = None
             self.seg += 1
+            if self.segment_done is not None:
+                self.segment_done(self.lsn)
+
+    def writev(self, buffers):
+        """Writes a sequence of buffers with one writev call per output
+        segment they touch."""
+        batch = []
+        room = XLOG_SIZE - (self.lsn & XLOG_SIZE_MASK)
+        for data in buffers:
+            data = memoryview(data)
+            while len(data) >= room:
+                batch.append(data[:room])
+                self._write_batch(batch)
+                batch = []
+                data = data[room:]
+                room = XLOG_SIZE
+            if len(data):
+                batch.append(data)
+                room -= len(data)
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        if self.output is None:
+            self.open_output()
+        self.output.flush()
+        fd = self.output.fileno()
+        for i in range(0, len(batch), IOV_MAX):
+            iov = batch[i:i+IOV_MAX]
+            total = sum(len(data) for data in iov)
+            written = os.writev(fd, iov)
+            if written < total:
+                rest = memoryview(b"".join(iov))[written:]
+                while len(rest):
+                    rest = rest[os.write(fd, rest):]
+            self.lsn += total
+        if self.lsn & XLOG_SIZE_MASK == 0:
+            self.output.close()
+            self.output = None
+            self.seg += 1
+            if self.segment_done is not None:
+                self.segment_done(self.lsn)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+class CompressedWalWriter(WalWriter):
+    """WalWriter that compresses every output segment, compression is one
+    of the COMPRESSIONS suffixes."""
+    def __init__(self, path, tli, start_lsn, compression):
+        self.compression = compression
+        WalWriter.__init__(self, path, tli, start_lsn)
+
+    @property
+    def output_path(self):
+        return "%s/%08X%08X%08X%s" % (self.path, self.tli, self.seg>>8, self.seg&0xFF,
+                                      self.compression)
+
+    def open_output(self):
+        self.output = COMPRESSIONS[self.compression].open(self.output_path, 'wb')
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.write(data)
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DurableWalWriter(WalWriter):
+    """WalWriter for crash safe output.
+
+    Every segment is written to a .tmp file preallocated to full size,
+    through a page aligned buffer of buffer_size bytes. Completed segments
+    are fsynced fsync_batch at a time and then renamed into place, so a
+    segment under its final name is always complete. With rename=False
+    the .tmp files are left for the caller to rename."""
+    def __init__(self, path, tli, start_lsn, fsync_batch=8,
+                 buffer_size=1024*1024, rename=True):
+        WalWriter.__init__(self, path, tli, start_lsn)
+        self.fsync_batch = fsync_batch
+        self.rename = rename
+        # Anonymous mappings are page aligned
+        self.buffer = mmap.mmap(-1, buffer_size)
+        self.buffered = 0
+        self.fd = None
+        self.file_offset = 0
+        self.completed = []
+
+    @property
+    def tmp_path(self):
+        return self.output_path + ".tmp"
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            if self.fd is None:
+                self.open_segment()
+            amount = min(len(data), XLOG_SIZE - (self.lsn & XLOG_SIZE_MASK),
+                         len(self.buffer) - self.buffered)
+            self.buffer[self.buffered:self.buffered+amount] = data[:amount]
+            self.buffered += amount
+            self.lsn += amount
+            data = data[amount:]
+            if self.buffered == len(self.buffer):
+                self.flush_buffer()
+            if self.lsn & XLOG_SIZE_MASK == 0:
+                self.flush_buffer()
+                self.complete_segment()
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.write(data)
+
+    def open_segment(self):
+        self.fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.file_offset = self.lsn & XLOG_SIZE_MASK
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, XLOG_SIZE)
+            except OSError:
+                # Not supported by the filesystem, just grow as we go
+                pass
+
+    def flush_buffer(self):
+        with memoryview(self.buffer) as view:
+            data = view[:self.buffered]
+            while len(data):
+                written = os.pwrite(self.fd, data, self.file_offset)
+                self.file_offset += written
+                data = data[written:]
+            data.release()
+        self.buffered = 0
+
+    def complete_segment(self):
+        self.completed.append((self.fd, self.tmp_path, self.output_path, self.lsn))
+        self.fd = None
+        self.seg += 1
+        if len(self.completed) >= self.fsync_batch:
+            self.sync()
+
+    def sync(self):
+        for fd, tmp_path, output_path, end_lsn in self.completed:
+            os.fsync(fd)
+            os.close(fd)
+            if self.rename:
+                os.rename(tmp_path, output_path)
+        if self.completed and self.rename:
+            fsync_dir(self.path)
+        if self.segment_done is not None:
+            for fd, tmp_path, output_path, end_lsn in self.completed:
+                if end_lsn & XLOG_SIZE_MASK == 0:
+                    self.segment_done(end_lsn)
+        self.completed = []
+
+    def close(self):
+        if self.fd is not None:
+            # Partial last segment, e.g. at end of WAL
+            self.flush_buffer()
+            os.ftruncate(self.fd, self.file_offset)
+            self.completed.append((self.fd, self.tmp_path, self.output_path, self.lsn))
+            self.fd = None
+        self.sync()
+
+# Resuming. A serial run journals the filter state at segment boundaries
+# once the output up to there is complete, and --resume picks up from it.
+
+CHECKPOINT_FILE = "xlogfilter.checkpoint"
+
+class Journal(object):
+    """Checkpoint file for resuming an interrupted serial run.
+
+    filter_machine offers a checkpoint at the end of every input segment
+    (offer). It is only written out once the writer reports the output up to
+    that lsn complete (segment_done), which may happen first or, with a
+    threaded writer, later and on another thread. args are the options of
+    the run, a resume with different ones is refused."""
+    def __init__(self, path, args, durable=False):
+        self.path = path
+        self.args = args
+        self.durable = durable
+        self.pending = {}
+        self.done_lsn = 0
+        self.lock = threading.Lock()
+
+    def offer(self, lsn, state):
+        with self.lock:
+            if lsn <= self.done_lsn:
+                self.save(lsn, state)
+            else:
+                self.pending[lsn] = state
+
+    def segment_done(self, end_lsn):
+        with self.lock:
+            self.done_lsn = end_lsn
+            ready = [lsn for lsn in self.pending if lsn <= end_lsn]
+            if ready:
+                lsn = max(ready)
+                self.save(lsn, self.pending[lsn])
+                for lsn in ready:
+                    del self.pending[lsn]
+
+    def save(self, lsn, state):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as fd:
+            json.dump({
+                "args": self.args,
+                "lsn": format_lsn(lsn),
+                "state": state.state,
+                "substate": state.substate,
+                "amount": state.amount,
+                "rem_len": state.rem_len,
+                "buf": state.buf.hex(),
+                "buf_lsn": format_lsn(state.buf_lsn),
+                "buf_headers": [(format_lsn(head_lsn), header.hex())
+                                for head_lsn, header in state.buf_headers],
+            }, fd)
+            if self.durable:
+                fd.flush()
+                os.fsync(fd.fileno())
+        os.rename(tmp_path, self.path)
+
+    def load(self):
+        """Returns (lsn, FilterState) of the last checkpoint."""
+        with open(self.path) as fd:
+            saved = json.load(fd)
+        if saved["args"] != self.args:
+            raise ValueError("checkpoint is from a run with other options: %s" %
+                             " ".join(saved["args"]))
+        return parse_lsn(saved["lsn"]), FilterState(
+            saved["state"], saved["substate"], saved["amount"], saved["rem_len"],
+            bytes.fromhex(saved["buf"]), parse_lsn(saved["buf_lsn"]),
+            [(parse_lsn(head_lsn), bytes.fromhex(header))
+             for head_lsn, header in saved["buf_headers"]])
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+# Pipelined filtering. A reader thread maps segments ahead of the filter and
+# asks the kernel to start reading them, the filter runs on the main thread
+# and a writer thread drains its output in large vectored writes, so that
+# reads and writes overlap with the CPU work.
+
+def prefetch_files(startfile, depth=4, end_lsn=None):
+    """read_files() running up to depth segments ahead in a thread."""
+    segments = queue.Queue(maxsize=depth)
+    def reader():
+        try:
+            for data in read_files(startfile, end_lsn=end_lsn):
+                if isinstance(data.obj, mmap.mmap) and hasattr(mmap, "MADV_WILLNEED"):
+                    data.obj.madvise(mmap.MADV_WILLNEED)
+                segments.put(data)
+            segments.put(None)
+        except Exception as e:
+            segments.put(e)
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    while True:
+        data = segments.get()
+        if data is None:
+            return
+        if isinstance(data, Exception):
+            raise data
+        yield data
+
+class ThreadedWalWriter(object):
+    """Hands output to writer on a separate thread, in batches of about
+    batch_size bytes, at most depth batches behind."""
+    def __init__(self, writer, batch_size=4*1024*1024, depth=4):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_len = 0
+        self.batches = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        # data must not change after this, the filter only passes slices of
+        # mapped segments and copies out of its buffer
+        self.pending.append(data)
+        self.pending_len += len(data)
+        if self.pending_len >= self.batch_size:
+            self.flush()
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.write(data)
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.pending:
+            self.batches.put(self.pending)
+            self.pending = []
+            self.pending_len = 0
+
+    def drain(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.error is None:
+                try:
+                    self.writer.writev(batch)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
 
 def parse_xlog_filename(filename):
     tli = int(filename[0:8], 16)
-    seg = (int(filename[8:16], 16)<<8) + int(filename[16:], 16)
+    seg = (int(filename[8:16], 16)<<8) + int(filename[16:24], 16)
     return tli, seg
 
 import sys
-def read_files(startfile):
+def read_files(startfile, verbose=True, ahead=4, end_lsn=None):
+    """Maps the segments from startfile on, up to the one holding the byte
+    before end_lsn."""
     filename = os.path.basename(startfile)
-    path = os.path.dirname(startfile)
+    path = os.path.dirname(startfile) or "."
     
     tli, seg = parse_xlog_filename(filename)
+    seg, end_seg = segment_catalog(path).lsn_range(tli, seg*XLOG_SIZE, end_lsn)
     
-    xlogfile = "%s/%08X%08X%08X" % (path, tli, seg>>8, seg&0xFF)
-    while os.path.exists(xlogfile):
-        print "    - filtering %r" % xlogfile
-        with open(xlogfile) as fd:
-            data = fd.read(8192)
-            while data != "":
-                yield data
-                data = fd.read(8192)
+    for xlogfile in segment_files(path, tli, seg, end_seg, ahead=ahead, verbose=False):
+        if verbose:
+            print("    - filtering %r" % xlogfile)
+        yield map_segment(xlogfile)
+
+# Segment-wise filtering. Every segment is filtered on its own, possibly by
+# a pool worker, which copies the tail of the record continued from the
+# previous segment as is and follows its own last record into the next
+# segment. What it writes past its segment end (the spill) is what the
+# previous worker should have produced for the next segment's continuation,
+# so the only serial step is patching each spill over the start of the
+# following output segment. Segments a pre-scan finds clean don't need the
+# state machine at all and are copied by the kernel.
+
+# Record data bytes in a segment after the long page header
+SEGMENT_DATA_LEN = (XLOG_SIZE - LONG_HEADER_LEN -
+                    (XLOG_SIZE//XLOG_BLCKSZ - 1)*HEADER_LEN)
+
+class SegmentWriter(object):
+    """Writes a single segment through writer, output past its end goes to
+    spill."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.lsn = writer.lsn
+        self.end_lsn = (self.lsn & ~XLOG_SIZE_MASK) + XLOG_SIZE
+        self.spill = []
+
+    def write(self, data):
+        room = self.end_lsn - self.lsn
+        self.lsn += len(data)
+        if len(data) <= room:
+            self.writer.write(data)
+            return
+        if room > 0:
+            self.writer.write(data[:room])
+            data = data[room:]
+        self.spill.append(bytes(data))
+
+    def writev(self, buffers):
+        for data in buffers:
+            self.write(data)
+
+    def close(self):
+        self.writer.close()
+
+def filter_segment(task):
+    """Pool worker, returns (spill, end of WAL reached, FilterStats or None)."""
+    path, tli, seg, outpath, rec_filter, first, durable, instrument = task
+    xlogfile = segment_file(path, tli, seg)
+    print("    - filtering %r" % xlogfile)
+    start_lsn = seg*XLOG_SIZE
+    if durable:
+        # Left as .tmp, filter_segments patches and renames it
+        writer = SegmentWriter(DurableWalWriter(outpath, tli, start_lsn, rename=False))
+    else:
+        writer = SegmentWriter(WalWriter(outpath, tli, start_lsn))
+    stats = FilterStats(start_lsn) if instrument else None
+    data = map_segment(xlogfile)
+    header = XLogLongPageHeader(*struct.unpack("HHILILII", data[0:LONG_HEADER_LEN]))
+    if not first and header.rem_len > SEGMENT_DATA_LEN:
+        # Nothing but continuation, the spill of an earlier segment covers it
+        writer.write(data)
+        writer.close()
+        if stats is not None:
+            stats.copied += len(data)
+            stats.finish()
+        return b"", False, stats
+    del data
+    end_of_wal = filter_machine(start_lsn, read_files(xlogfile, verbose=False, ahead=1), writer,
+                                rec_filter, end_lsn=writer.end_lsn,
+                                skip_contrecord=not first, stats=stats)
+    if stats is not None:
+        stats.writer(writer).close()
+        stats.finish()
+    else:
+        writer.close()
+    return b"".join(writer.spill), end_of_wal, stats
+
+def classify_segments(path, tli, seg, rec_filter):
+    """Walks the record headers from seg on. Returns (dirty, end_seg): the
+    segments overlapping a record that will be filtered, plus the first one,
+    and the segment where WAL ends, None if it runs to the last file."""
+    dirty = set([seg])
+    reader = xlogreader(xlogfilereader(path, tli, seg))
+    reader.skip_contrecord()
+    try:
+        while True:
+            lsn, data = reader.read(RECORD_HEADER_LEN, align=True)
+            rec = parse_record(data)
+            if rec.tot_len == 0:
+                # filter_machine stops writing here
+                dirty.add(lsn // XLOG_SIZE)
+                return dirty, lsn // XLOG_SIZE
+            rem_len = rec.tot_len - RECORD_HEADER_LEN
+            verdict = rec_filter.decide(rec, lsn)
+            filtered = verdict == FILTER
+            if verdict == NEED_NODE and rem_len >= FILENODE_LEN:
+                _, data = reader.read(FILENODE_LEN)
+                rem_len -= FILENODE_LEN
+                filtered = rec_filter.node_check(parse_relfilenode(data))
+            if rem_len:
+                reader.skip(rem_len)
+            if filtered:
+                dirty.update(range(lsn // XLOG_SIZE, (reader.pos - 1) // XLOG_SIZE + 1))
+            if rec.rmid == RM_XLOG_ID and (rec.info & 0xF0) == I["XLOG_SWITCH"]:
+                to_next_seg = XLOG_SIZE - (reader.pos & XLOG_SIZE_MASK)
+                if to_next_seg < XLOG_SIZE:
+                    reader.fd.read(to_next_seg)
+                    reader.pos += to_next_seg
+    except EOFError:
+        return dirty, None
+
+# ioctl to share the extents of a file, on btrfs, XFS and the like
+FICLONE = 0x40049409
+
+def copy_segment(src, dest, link=False):
+    """Copies a segment without passing the data through Python, as a
+    reflink where the filesystem can, else using copy_file_range or
+    sendfile where available, or hard-links it. Compressed segments are
+    decompressed into dest."""
+    if os.path.exists(dest):
+        os.unlink(dest)
+    compression = compression_of(src)
+    if compression is not None:
+        with COMPRESSIONS[compression].open(src, 'rb') as fin, open(dest, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, XLOG_BLCKSZ*128)
+        return
+    if link:
+        os.link(src, dest)
+        return
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return
+        except OSError:
+            pass
+        size = os.fstat(fin.fileno()).st_size
+        offset = 0
+        for name in ("copy_file_range", "sendfile"):
+            kernel_copy = getattr(os, name, None)
+            if kernel_copy is None:
+                continue
+            try:
+                while offset < size:
+                    if name == "sendfile":
+                        copied = kernel_copy(fout.fileno(), fin.fileno(), offset, size - offset)
+                    else:
+                        copied = kernel_copy(fin.fileno(), fout.fileno(), size - offset, offset, offset)
+                    if not copied:
+                        break
+                    offset += copied
+                return
+            except OSError:
+                # Not supported for these files, e.g. across filesystems
+                continue
+        fin.seek(offset)
+        fout.seek(offset)
+        shutil.copyfileobj(fin, fout, XLOG_BLCKSZ*128)
+
+# Patch mode. Filtering only ever changes the header of a filtered record
+# and zeroes its data, so instead of passing everything through
+# filter_machine the segments are copied (or left where they are) and just
+# those bytes are written through mmap.
+
+def data_ranges(lsn, length):
+    """Splits length bytes of record data from lsn into page-contiguous
+    (lsn, length) ranges, stepping over page headers."""
+    ranges = []
+    while length:
+        if lsn & XLOG_SIZE_MASK == 0:
+            lsn += LONG_HEADER_LEN
+        elif lsn & XLOG_BLCK_MASK == 0:
+            lsn += HEADER_LEN
+        amount = min(length, XLOG_BLCKSZ - (lsn & XLOG_BLCK_MASK))
+        ranges.append((lsn, amount))
+        lsn += amount
+        length -= amount
+    return ranges
+
+# Bytes of the header write_noop_rec sets, the rest is padding
+NOOP_HEADER_LEN = RECORD_STRUCT.size
+
+def plan_patches(path, tli, seg, rec_filter):
+    """Walks the record headers from seg on. Returns (patches, nrecs,
+    end_lsn): the (lsn, length, data) writes that turn the records
+    rec_filter picks into XLOG_NOOP, data None meaning zeroes, the number of
+    those records, and where filter_machine would stop writing, None if it
+    would write all segments."""
+    patches = []
+    nrecs = 0
+    reader = xlogreader(xlogfilereader(path, tli, seg))
+    reader.skip_contrecord()
+    while True:
+        # filter_machine buffers from here until it knows the verdict
+        start = align8(reader.pos)
+        try:
+            lsn, data = reader.read(RECORD_HEADER_LEN, align=True)
+            rec = parse_record(data)
+            if rec.tot_len == 0:
+                return patches, nrecs, start
+            rem_len = rec.tot_len - RECORD_HEADER_LEN
+            verdict = rec_filter.decide(rec, lsn)
+            filtered = verdict == FILTER
+            skipped = 0
+            if verdict == NEED_NODE and rem_len >= FILENODE_LEN:
+                _, data = reader.read(FILENODE_LEN)
+                skipped = FILENODE_LEN
+                filtered = rec_filter.node_check(parse_relfilenode(data))
+        except EOFError:
+            return patches, nrecs, start
+        try:
+            if rem_len > skipped:
+                reader.skip(rem_len - skipped)
+        except EOFError:
+            filtered = False
+        if filtered:
+            print("        - Filter record %s at %08X" % (RM_NAMES[rec.rmid], lsn))
+            nrecs += 1
+            buf = bytearray(RECORD_HEADER_LEN + FILENODE_LEN)
+            write_noop_rec(buf, rec)
+            header_ranges = data_ranges(lsn, RECORD_HEADER_LEN)
+            offset = 0
+            for piece_lsn, amount in header_ranges:
+                amount = min(amount, NOOP_HEADER_LEN - offset)
+                if amount > 0:
+                    patches.append((piece_lsn, amount, bytes(buf[offset:offset+amount])))
+                offset += amount
+            data_lsn = header_ranges[-1][0] + header_ranges[-1][1]
+            for piece_lsn, amount in data_ranges(data_lsn, rem_len):
+                patches.append((piece_lsn, amount, None))
+        if rec.rmid == RM_XLOG_ID and (rec.info & 0xF0) == I["XLOG_SWITCH"]:
+            to_next_seg = XLOG_SIZE - (reader.pos & XLOG_SIZE_MASK)
+            if to_next_seg < XLOG_SIZE:
+                try:
+                    reader.fd.read(to_next_seg)
+                except EOFError:
+                    return patches, nrecs, None
+                reader.pos += to_next_seg
+
+def patch_segments(start_file, outpath, rec_filter):
+    """Filters by patching. Segments are copied to outpath, as reflinks
+    where possible, unless outpath is the input directory, in which case
+    they are patched in place. Copies end where filter_machine would stop
+    writing, segments patched in place are left whole."""
+    path = os.path.dirname(start_file) or "."
+    tli, seg = parse_xlog_filename(os.path.basename(start_file))
+    in_place = os.path.samefile(path, outpath)
+    patches, nrecs, end_lsn = plan_patches(path, tli, seg, rec_filter)
+
+    by_seg = {}
+    for patch in patches:
+        by_seg.setdefault(patch[0] // XLOG_SIZE, []).append(patch)
+    npatched = 0
+    while True:
+        xlogfile = segment_file(path, tli, seg)
+        if xlogfile is None or (end_lsn is not None and seg*XLOG_SIZE >= end_lsn and not in_place):
+            break
+        outfile = "%s/%08X%08X%08X" % (outpath, tli, seg>>8, seg&0xFF)
+        if not in_place:
+            copy_segment(xlogfile, outfile)
+            if end_lsn is not None and end_lsn < (seg + 1)*XLOG_SIZE:
+                os.truncate(outfile, end_lsn - seg*XLOG_SIZE)
+        if seg in by_seg:
+            with open(outfile, 'r+b') as fd:
+                data = mmap.mmap(fd.fileno(), 0)
+                try:
+                    for lsn, length, patch in by_seg[seg]:
+                        offset = lsn & XLOG_SIZE_MASK
+                        data[offset:offset+length] = patch if patch is not None else ZERO_PAGE[:length]
+                    data.flush()
+                finally:
+                    data.close()
+            npatched += 1
         seg += 1
-        xlogfile = "%s/%08X%08X%08X" % (path, tli, seg>>8, seg&0xFF)
+    print("Turned %d records into XLOG_NOOP, patched %d segments" % (nrecs, npatched))
+
+def filter_segments(start_file, outpath, rec_filter, jobs=1, clean=None,
+                    durable=False, fsync_batch=8, stats=None):
+    """Filters segment-wise, in a pool of jobs processes if jobs > 1. With
+    clean set to "copy" or "link" segments without anything to filter are
+    copied or hard-linked instead. With durable, segments are written as
+    .tmp files and renamed into place once complete and fsynced, the
+    directory is fsynced every fsync_batch segments. The counters of the
+    workers are merged into stats if given."""
+    path = os.path.dirname(start_file) or "."
+    tli, seg = parse_xlog_filename(os.path.basename(start_file))
+    segs = []
+    while segment_file(path, tli, seg) is not None:
+        segs.append(seg)
+        seg += 1
+    if not segs:
+        return
+
+    dirty = set(segs)
+    if clean:
+        dirty, end_seg = classify_segments(path, tli, segs[0], rec_filter)
+        if end_seg is not None:
+            segs = [seg for seg in segs if seg <= end_seg]
+    tasks = [(path, tli, seg, outpath, rec_filter, seg == segs[0], durable, stats is not None)
+             for seg in segs if seg in dirty]
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(filter_segment, tasks)
+    else:
+        results = map(filter_segment, tasks)
+    try:
+        pending = b""
+        end_of_wal = False
+        renamed = 0
+        for seg in segs:
+            xlogfile = segment_file(path, tli, seg)
+            outfile = "%s/%08X%08X%08X" % (outpath, tli, seg>>8, seg&0xFF)
+            tmpfile = outfile + ".tmp" if durable else outfile
+            if seg in dirty:
+                spill, seg_end_of_wal, seg_stats = next(results)
+                if seg_stats is not None:
+                    stats.merge(seg_stats)
+            elif not end_of_wal:
+                print("    - copying clean %r" % xlogfile)
+                if clean == "link" or not durable:
+                    copy_segment(xlogfile, outfile, link=(clean == "link"))
+                else:
+                    copy_segment(xlogfile, tmpfile)
+                    fd = os.open(tmpfile, os.O_WRONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    os.rename(tmpfile, outfile)
+                renamed += 1
+                if stats is not None:
+                    # Less the spill, the segment writing it counted that
+                    stats.copied += XLOG_SIZE - len(pending[:XLOG_SIZE])
+                    stats.segments += 1
+                    stats.lsn = max(stats.lsn, (seg + 1)*XLOG_SIZE)
+                    stats.tick()
+                # Whatever spills into a clean segment equals its contents
+                pending = b""
+                continue
+            if end_of_wal:
+                # A serial run stops at end of WAL, so must we
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+                continue
+            if pending:
+                fd = os.open(tmpfile, os.O_WRONLY)
+                try:
+                    os.pwrite(fd, pending[:XLOG_SIZE], 0)
+                    if durable:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+                if stats is not None:
+                    # Copied as is by this segment's run and counted by the
+                    # run writing the spill too
+                    stats.copied -= len(pending[:XLOG_SIZE])
+                pending = pending[XLOG_SIZE:]
+            if durable:
+                os.rename(tmpfile, outfile)
+                renamed += 1
+            pending += spill
+            end_of_wal = seg_end_of_wal
+            if durable and renamed >= fsync_batch:
+                fsync_dir(outpath)
+                renamed = 0
+        if durable and renamed:
+            fsync_dir(outpath)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 from optparse import OptionParser
 
-parser = OptionParser()
-parser.add_option("-x", "--exclude", dest="exclude", action="append", type="string",
-                help="Filter out a filenode. Format: tablespaceoid,databaseoid,filenode")
-(options, args) = parser.parse_args()
+def verify(start_file, fmt):
+    path = os.path.dirname(start_file) or "."
+    tli, seg = parse_xlog_filename(os.path.basename(start_file))
+    reader = xlogreader(xlogfilereader(path, tli, seg))
+    reader.skip_contrecord()
+
+    start = time.time()
+    nrecs, bad_lsn = verify_records(reader, fmt)
+    elapsed = max(time.time() - start, 1e-6)
+    size = reader.pos - seg*XLOG_SIZE
+    print("Verified %d records, %.1f MB in %.1fs (%.1f MB/s, %.0f records/s)" % (
+        nrecs, size/1e6, elapsed, size/1e6/elapsed, nrecs/elapsed))
+    if bad_lsn is not None:
+        print("First bad or unfinished record at %s" % format_lsn(bad_lsn))
+        return False
+    print("No bad records up to %s" % format_lsn(reader.pos))
+    return True
+
+def bench_records(start_file, blocks=False):
+    """Times iterating records() from start_file, optionally decoding the
+    backup blocks of each record as well."""
+    path = os.path.dirname(start_file) or "."
+    tli, seg = parse_xlog_filename(os.path.basename(start_file))
+    nrecs = 0
+    size = 0
+    start = time.time()
+    for rec in records(path, tli, seg):
+        nrecs += 1
+        size += rec.header.tot_len
+        if blocks:
+            rec.blocks
+    elapsed = max(time.time() - start, 1e-6)
+    print("Read %d records%s, %.1f MB in %.2fs (%.0f records/s, %.1f MB/s)" % (
+        nrecs, " with backup blocks" if blocks else "", size/1e6, elapsed,
+        nrecs/elapsed, size/1e6/elapsed))
+
+def write_stats(stats, path):
+    if stats is None or not path:
+        return
+    if path == "-":
+        json.dump(stats.as_dict(), sys.stdout, indent=1)
+        print()
+    else:
+        with open(path, 'w') as fd:
+            json.dump(stats.as_dict(), fd, indent=1)
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-x", "--exclude", dest="exclude", action="append", type="string",
+                    help="Filter out a filenode. Format: tablespaceoid,databaseoid,filenode")
+    parser.add_option("-d", "--exclude-db", dest="exclude_db", action="append", type="int",
+                    help="Filter out all records about relations of a database OID")
+    parser.add_option("-T", "--exclude-tablespace", dest="exclude_spc", action="append", type="int",
+                    help="Filter out all records about relations in a tablespace OID")
+    parser.add_option("-R", "--exclude-rmgr", dest="exclude_rmgr", action="append", type="string",
+                    help="Filter out records of a resource manager, optionally only one info. "
+                         "Format: Heap or Heap:XLOG_HEAP_INSERT")
+    parser.add_option("--exclude-xid", dest="exclude_xid", action="append", type="string",
+                    help="Filter out records of a transaction or range. Format: 1234 or 1234-1300")
+    parser.add_option("--exclude-lsn", dest="exclude_lsn", action="append", type="string",
+                    help="Filter out records starting in a range. Format: 0/1000000-0/2000000")
+    parser.add_option("--verify", dest="verify", action="store_true", default=False,
+                    help="Only check the CRC of every record, starting at startseg")
+    parser.add_option("--crc", dest="crc", type="choice", choices=sorted(RECORD_FORMATS),
+                    default="legacy",
+                    help="WAL format to verify: legacy (pre-9.5) or crc32c (9.5+)")
+    parser.add_option("--bench", dest="bench", action="store_true", default=False,
+                    help="Only time decoding the records from startseg, with and without backup blocks")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                    help="Filter segments in parallel using JOBS processes")
+    parser.add_option("--copy-clean", dest="clean", action="store_const", const="copy",
+                    help="Pre-scan and copy segments with nothing to filter in the kernel")
+    parser.add_option("--link-clean", dest="clean", action="store_const", const="link",
+                    help="Pre-scan and hard-link segments with nothing to filter")
+    parser.add_option("--pipeline", dest="pipeline", action="store_true", default=False,
+                    help="Read ahead and write behind in separate threads")
+    parser.add_option("--durable", dest="durable", action="store_true", default=False,
+                    help="Preallocate output segments, fsync them and rename them into place")
+    parser.add_option("-z", "--compress", dest="compress", type="choice",
+                    choices=sorted(ext[1:] for ext in COMPRESSIONS),
+                    help="Write segments compressed with gz, xz or bz2")
+    parser.add_option("--patch", dest="patch", action="store_true", default=False,
+                    help="Copy segments as reflinks where possible and only patch the filtered "
+                         "records. Patches in place if outdir is the input directory")
+    parser.add_option("--resume", dest="resume", action="store_true", default=False,
+                    help="Continue an interrupted run from its checkpoint in outdir")
+    parser.add_option("--fsync-batch", dest="fsync_batch", type="int", default=8,
+                    help="With --durable, fsync this many segments at a time [default: %default]")
+    parser.add_option("--stats", dest="stats", metavar="FILE",
+                    help="Write counters and timings of the run as JSON to FILE, - for stdout")
+    parser.add_option("--end-lsn", dest="end_lsn",
+                    help="Stop after the segment holding the byte before LSN (X/X). "
+                         "Output is whole segments, so the start is startseg")
+    parser.add_option("--progress", dest="progress", type="float", metavar="SECS",
+                    help="Print a progress line every SECS seconds")
+    (options, args) = parser.parse_args()
+
+    if options.verify:
+        if len(args) < 1:
+            print("Usage: %s --verify [--crc legacy|crc32c] startseg" % sys.argv[0])
+            sys.exit(1)
+        if not verify(args[0], RECORD_FORMATS[options.crc]):
+            sys.exit(2)
+        return
 
-if len(args) < 2:
-    print "Usage: %s [-x 12345,67890,12435] startseg outdir" % sys.argv[0]
-    sys.exit(1)
+    if options.bench:
+        if len(args) < 1:
+            print("Usage: %s --bench startseg" % sys.argv[0])
+            sys.exit(1)
+        bench_records(args[0])
+        bench_records(args[0], blocks=True)
+        return
+
+    if len(args) < 2:
+        print("Usage: %s [-x 12345,67890,12435] startseg outdir" % sys.argv[0])
+        sys.exit(1)
+    if options.compress and (options.jobs > 1 or options.clean or options.durable):
+        print("--compress can't be combined with --jobs, --copy-clean, --link-clean or --durable")
+        sys.exit(1)
+
+    excludes = set()
+    if options.exclude:
+        for exclude in options.exclude:
+            match = filenode_re.match(exclude)
+            if not match:
+                print("Invalid filenode %s" % exclude)
+                sys.exit(1)
+            excludes.add(RelFileNode(*map(int, match.groups())))
+
+    rmids, rminfos = set(), set()
+    for exclude in options.exclude_rmgr or []:
+        rm_name, _, info_name = exclude.partition(":")
+        if rm_name not in RM_NAMES:
+            print("Invalid resource manager %s" % rm_name)
+            sys.exit(1)
+        rmid = RM_NAMES.index(rm_name)
+        if not info_name:
+            rmids.add(rmid)
+            continue
+        infos = dict((name, info) for info, name in INFOS[rmid].items())
+        if info_name not in infos or info_op(rmid, infos[info_name]) != infos[info_name]:
+            print("Invalid info %s for %s" % (info_name, rm_name))
+            sys.exit(1)
+        rminfos.add((rmid, infos[info_name]))
+
+    xids, xid_ranges, lsn_ranges = set(), [], []
+    try:
+        for exclude in options.exclude_xid or []:
+            if "-" in exclude:
+                xid_ranges.append(tuple(map(int, exclude.split("-", 1))))
+            else:
+                xids.add(int(exclude))
+        for exclude in options.exclude_lsn or []:
+            start, _, end = exclude.partition("-")
+            lsn_ranges.append((parse_lsn(start), parse_lsn(end or start)))
+    except ValueError:
+        print("Invalid xid or lsn range")
+        sys.exit(1)
+
+    rec_filter = RecordFilter(excludes, options.exclude_db or (),
+                              options.exclude_spc or (), rmids, rminfos,
+                              xids, xid_ranges, lsn_ranges)
+
+    start_file = args[0]
+    outpath = args[1]
+    tli, seg = parse_xlog_filename(os.path.basename(start_file))
+    start_lsn = seg*XLOG_SIZE
+    try:
+        end_lsn = parse_lsn(options.end_lsn) if options.end_lsn else None
+    except ValueError:
+        print("Invalid lsn %s" % options.end_lsn)
+        sys.exit(1)
+    if end_lsn is not None and (options.jobs > 1 or options.clean or options.patch):
+        print("--end-lsn only works for serial filtering")
+        sys.exit(1)
+    if options.resume and (options.jobs > 1 or options.clean):
+        print("--resume only works for serial filtering")
+        sys.exit(1)
+    if options.patch:
+        if options.jobs > 1 or options.clean or options.durable or options.resume:
+            print("--patch can't be combined with --jobs, --copy-clean, --link-clean, --durable or --resume")
+            sys.exit(1)
+        if options.stats or options.progress:
+            print("--stats and --progress don't apply to --patch")
+            sys.exit(1)
+        if compression_of(start_file) and os.path.samefile(os.path.dirname(start_file) or ".", outpath):
+            print("Compressed segments can't be patched in place")
+            sys.exit(1)
+        patch_segments(start_file, outpath, rec_filter)
+        return
+    instrument = options.stats or options.progress
+    if options.jobs > 1 or options.clean:
+        stats = FilterStats(start_lsn, options.progress) if instrument else None
+        filter_segments(start_file, outpath, rec_filter, options.jobs, options.clean,
+                        options.durable, options.fsync_batch, stats)
+        write_stats(stats, options.stats)
+        return
+
+    journal = Journal(os.path.join(outpath, CHECKPOINT_FILE),
+                      [arg for arg in sys.argv[1:] if arg != "--resume"],
+                      options.durable)
+    resume = None
+    if options.resume:
+        if not os.path.exists(journal.path):
+            print("No checkpoint in %s" % outpath)
+            sys.exit(1)
+        try:
+            start_lsn, resume = journal.load()
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        start_file = segment_file(os.path.dirname(start_file) or ".", tli, start_lsn // XLOG_SIZE)
+        if start_file is None:
+            print("Segment to resume at %s is missing" % format_lsn(start_lsn))
+            sys.exit(1)
+        print("Resuming at %s" % format_lsn(start_lsn))
+
+    if options.durable:
+        writer = DurableWalWriter(outpath, tli, start_lsn, options.fsync_batch)
+    elif options.compress:
+        writer = CompressedWalWriter(outpath, tli, start_lsn, "." + options.compress)
+    else:
+        writer = WalWriter(outpath, tli, start_lsn)
+    writer.segment_done = journal.segment_done
+    # (De)compression releases the GIL, so it overlaps with the filter when
+    # it runs in the reader and writer threads
+    if options.pipeline or options.compress:
+        writer = ThreadedWalWriter(writer)
+    if options.pipeline or compression_of(start_file):
+        src = prefetch_files(start_file, end_lsn=end_lsn)
+    else:
+        src = read_files(start_file, end_lsn=end_lsn)
+
+    stats = FilterStats(start_lsn, options.progress) if instrument else None
+    filter_machine(start_lsn, src, writer, rec_filter,
+                   checkpoint=journal.offer, resume=resume, stats=stats)
+    if stats is not None:
+        stats.writer(writer).close()
+        stats.finish()
+    else:
+        writer.close()
+    journal.remove()
+    write_stats(stats, options.stats)
 
 import re
 
 filenode_re = re.compile("^([0-9]+),([0-9]+),([0-9]+)$")
 
-excludes = set()
-if options.exclude:
-    for exclude in options.exclude:
-        match = filenode_re.match(exclude)
-        if not match:
-            print "Invalid filenode %s" % exclude
-            sys.exit(1)
-        excludes.add(RelFileNode(*map(int, match.groups())))
-
-start_file = args[0]
-outpath = args[1]
-tli, seg = parse_xlog_filename(os.path.basename(start_file))
-start_lsn = seg*XLOG_SIZE
-writer = WalWriter(outpath, tli, start_lsn)
-
-filter_machine(start_lsn, read_files(start_file), writer, excludes)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+if __name__ == "__main__":
+    main()